@@ -1,75 +1,61 @@
 #! /usr/bin/env python3
 
+import argparse
 import json
 import os
-import re
-from glob import glob
+import sys
 
+from conversion import add_heading_ids, build_heading_link_replacer
+from helpers import find_markdown_files, write_file_atomically
 
-filepaths = glob("**/*.md", recursive=True)
+
+parser = argparse.ArgumentParser(
+    description=("Add IDs to the headings in Markdown files")
+)
+
+parser.add_argument(
+    "--out-dir",
+    default=".",
+    help=(
+        "Write the files and heading-slugs.json here, "
+        "instead of over the source files"
+    ),
+)
+
+args = parser.parse_args()
+
+out_dir = os.path.abspath(args.out_dir)
+
+# Sorted, so the slug map is merged in the same order every time
+filepaths = find_markdown_files(out_dir)
+
+if not filepaths:
+    # Don't replace the existing slug map with an empty one
+    sys.exit("No markdown files to add heading IDs to")
 
 heading_slugs = {}
+heading_slugs_path = os.path.join(out_dir, "heading-slugs.json")
+contents = {}
 
-if os.path.isfile("heading-slugs.json"):
-    with open("heading-slugs.json") as heading_slugs_handle:
+if os.path.isfile(heading_slugs_path):
+    with open(heading_slugs_path) as heading_slugs_handle:
         heading_slugs = json.load(heading_slugs_handle)
 
 for path in filepaths:
     with open(path) as read_handle:
         content = read_handle.read()
 
-    headings = re.findall("(^#{2,4} .*)", content, flags=re.MULTILINE)
-
-    for heading in headings:
-        elem = None
-        heading_body = ""
-
-        if heading[:3] == "## ":
-            elem = "h2"
-            heading_body = heading[3:]
-        elif heading[:4] == "### ":
-            elem = "h3"
-            heading_body = heading[4:]
-        elif heading[:5] == "#### ":
-            elem = "h4"
-            heading_body = heading[5:]
-
-        old_heading_slug = (
-            heading_body.replace(" ", "-").replace("`", "").lower()
-        )
-        new_heading_slug = "heading--" + re.sub(
-            "[^\w-]", "", old_heading_slug
-        ).strip("-")
-
-        heading_slugs[old_heading_slug] = new_heading_slug
-
-        heading_html = (
-            f'<{elem} id="{new_heading_slug}">{heading_body}</{elem}>'
-        )
-        content = re.sub(
-            f"^{re.escape(heading)}$",
-            heading_html,
-            content,
-            flags=re.MULTILINE,
-        )
-
-    with open(path, "w") as write_handle:
-        write_handle.write(content)
-
-# Now update the heading links
-for path in filepaths:
-    for old_heading_slug, new_heading_slug in heading_slugs.items():
-        with open(path) as read_handle:
-            content = read_handle.read()
+    contents[path], file_heading_slugs = add_heading_ids(content)
+    heading_slugs.update(file_heading_slugs)
 
-        content = re.sub(
-            "#" + re.escape(old_heading_slug) + r"([\]\)$])",
-            "#" + new_heading_slug + r"\1",
-            content,
-        )
+# Now update the heading links, and write each file once
+update_heading_links = build_heading_link_replacer(heading_slugs)
 
-        with open(path, "w") as write_handle:
-            write_handle.write(content)
+for path, content in contents.items():
+    write_file_atomically(
+        os.path.join(out_dir, path), update_heading_links(content)
+    )
 
-with open("heading-slugs.json", "w") as heading_slugs_handle:
-    json.dump(heading_slugs, heading_slugs_handle, indent=4, sort_keys=True)
+write_file_atomically(
+    heading_slugs_path, json.dumps(heading_slugs, indent=4, sort_keys=True)
+)
@@ -0,0 +1,588 @@
+#! /usr/bin/env python3
+
+# Standard library
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from glob import glob
+
+# Local imports
+from conversion import (
+    add_heading_ids,
+    build_heading_link_replacer,
+    build_media_index,
+    convert_file,
+    convert_foldouts,
+    convert_metadata,
+    convert_notifications,
+    fix_pandoc_output,
+    read_links_block,
+    replace_media_urls,
+    run_pandoc,
+    strip_style_tags,
+)
+from helpers import build_link_replacer
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description=(
+        "Time each stage of converting a generated "
+        "documentation-builder corpus of growing size"
+    )
+)
+
+parser.add_argument(
+    "--sizes",
+    default="50,200,800",
+    help=("Comma-separated numbers of files to generate and convert"),
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=0,
+    help=("Seed for generating the corpus, so runs can be compared"),
+)
+parser.add_argument(
+    "--output", help=("Save the results to this file, as JSON")
+)
+parser.add_argument(
+    "--compare",
+    help=("Results from an earlier run, to compare these results against"),
+)
+parser.add_argument(
+    "--no-pandoc",
+    action="store_true",
+    help=("Skip the pandoc stage, even if pandoc is installed"),
+)
+
+# Each corpus is measured in a fresh process, which is run with these
+parser.add_argument(
+    "--measure", choices=["pipeline", "stages"], help=argparse.SUPPRESS
+)
+parser.add_argument("--corpus-dir", help=argparse.SUPPRESS)
+parser.add_argument("--result-file", help=argparse.SUPPRESS)
+
+args = parser.parse_args()
+
+sizes = [int(size) for size in args.sizes.split(",")]
+use_pandoc = not args.no_pandoc and shutil.which("pandoc")
+
+if not use_pandoc and not args.measure:
+    print("> Not timing pandoc (not installed, or --no-pandoc)")
+
+
+# Corpus generation
+# ===
+
+words = (
+    "juju maas machine controller model charm application unit relation "
+    "deploy cloud network storage subnet space commission release node "
+    "bundle config action hook leader series region rack zone pool image "
+    "the a to of and with for from when this that you can will is be"
+).split()
+
+
+def sentence(rng, link_names):
+    """
+    A sentence of filler, sometimes with a cross-link or inline code
+    """
+
+    sentence_words = rng.choices(words, k=rng.randint(6, 18))
+
+    if rng.random() < 0.3:
+        name = rng.choice(link_names)
+        sentence_words.append(f"([{name}]({name}.md))")
+
+    if rng.random() < 0.1:
+        anchor = "-".join(rng.choices(words, k=2))
+        sentence_words.append(f"([see below](#{anchor}))")
+
+    if rng.random() < 0.2:
+        sentence_words.insert(
+            rng.randrange(len(sentence_words)), f"`{rng.choice(words)}`"
+        )
+
+    return " ".join(sentence_words).capitalize() + "."
+
+
+def paragraph(rng, link_names):
+    return " ".join(
+        sentence(rng, link_names) for _ in range(rng.randint(2, 5))
+    )
+
+
+def generate_page(rng, link_names, media_paths):
+    """
+    Generate a page in the shape of juju-docs and maas-docs pages:
+    a metadata header, h2-h4 headings, "!!! Note" notifications,
+    "^#" foldouts, cross-links, media and a "<!-- LINKS -->" block
+    """
+
+    title = " ".join(rng.choices(words, k=rng.randint(2, 5))).capitalize()
+    reference_names = rng.sample(link_names, min(3, len(link_names)))
+
+    lines = [f"Title: {title}", "TODO: Check this page is up to date", ""]
+    lines += [paragraph(rng, link_names), ""]
+
+    for _ in range(rng.randint(2, 6)):
+        heading = f"{rng.choice(words).capitalize()} {rng.choice(words)}"
+        lines += [f"## {heading}", ""]
+
+        for _ in range(rng.randint(1, 3)):
+            depth = rng.choice(["", "###", "####"])
+
+            if depth:
+                heading = " ".join(rng.choices(words, k=3)).capitalize()
+                lines += [f"{depth} {heading}", ""]
+
+            lines += [paragraph(rng, link_names), ""]
+
+            roll = rng.random()
+
+            if roll < 0.2:
+                note_type = rng.choice(["Note", "Warning", "Positive"])
+                lines += [
+                    f'!!! {note_type} "{rng.choice(words).capitalize()}":',
+                    "    " + sentence(rng, link_names),
+                    "    " + sentence(rng, link_names),
+                    "",
+                ]
+            elif roll < 0.35:
+                lines += [
+                    f"^# {rng.choice(words).capitalize()} details",
+                    "",
+                    "    " + sentence(rng, link_names),
+                    f"    See [{reference_names[0]}][{reference_names[0]}].",
+                    "",
+                ]
+            elif roll < 0.5:
+                media_path = rng.choice(media_paths)
+                lines += [f"![{rng.choice(words)}]({media_path})", ""]
+            elif roll < 0.6:
+                lines += [
+                    "```bash",
+                    f"juju {rng.choice(words)} {rng.choice(words)}",
+                    "```",
+                    "",
+                ]
+
+    lines += ["", "<!-- LINKS -->", ""]
+    lines += [f"[{name}]: ./{name}.md" for name in reference_names]
+
+    return "\n".join(lines) + "\n"
+
+
+def generate_corpus(directory, file_count, rng):
+    """
+    Write "file_count" pages into "directory"/en,
+    returning their paths and a list of uploaded media
+    like uploaded-media.json
+    """
+
+    page_directory = os.path.join(directory, "en")
+    os.makedirs(page_directory)
+
+    names = [f"page-{index:05}" for index in range(file_count)]
+    media_paths = [
+        f"../media/image-{index:04}.png"
+        for index in range(max(10, file_count // 4))
+    ]
+    images_map = [
+        {
+            "local_filepath": os.path.normpath(
+                os.path.join(page_directory, media_path)
+            ),
+            "url": f"https://assets.example.com/{index:04}-image.png",
+        }
+        # Leave some media unuploaded, so they're reported as missing
+        for index, media_path in enumerate(media_paths[:-2])
+    ]
+
+    paths = []
+
+    for name in names:
+        path = os.path.join(page_directory, name + ".md")
+
+        with open(path, "w") as page_file:
+            page_file.write(generate_page(rng, names, media_paths))
+
+        paths.append(path)
+
+    return paths, images_map
+
+
+# Benchmark
+# ===
+
+
+def timed(stage_times, stage, function, *arguments):
+    """
+    Run a stage on its own, adding its duration to "stage_times".
+    Stages that produce generators are consumed into lists,
+    so their own work is timed rather than the next stage's.
+    """
+
+    start = time.perf_counter()
+    result = function(*arguments)
+
+    if isinstance(result, tuple):
+        result = tuple(
+            list(item) if hasattr(item, "__next__") else item
+            for item in result
+        )
+    elif hasattr(result, "__next__"):
+        result = list(result)
+
+    stage_times[stage] += time.perf_counter() - start
+
+    return result
+
+
+def peak_rss_mb(who):
+    """
+    The peak resident memory of this process (resource.RUSAGE_SELF),
+    or of the largest child process it has waited for
+    (resource.RUSAGE_CHILDREN), in MB
+    """
+
+    peak_rss = resource.getrusage(who).ru_maxrss
+
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+
+    return peak_rss / 1024 / 1024
+
+
+def build_topics(paths):
+    """
+    Pretend every file has been uploaded, to rewrite links to them
+    """
+
+    return {
+        path: {"id": index, "slug": path[:-3]}
+        for index, path in enumerate(paths)
+    }
+
+
+def measure_pipeline(paths, images_map):
+    """
+    Convert every file with convert_file, as convert.py does
+    without the cache, then rewrite heading links and topic links,
+    as convert.py and upload.py do
+    """
+
+    stage_times = Counter()
+    converted_contents = {}
+    heading_slugs = {}
+
+    start = time.perf_counter()
+    media_index = build_media_index(images_map)
+
+    for path in paths:
+        title, content, file_heading_slugs, _ = convert_file(
+            path, media_index, use_pandoc=bool(use_pandoc)
+        )
+        heading_slugs.update(file_heading_slugs)
+        converted_contents[path] = content
+
+    stage_times["convert_file"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    update_heading_links = build_heading_link_replacer(heading_slugs)
+
+    for path, content in converted_contents.items():
+        converted_contents[path] = update_heading_links(content)
+
+    stage_times["update_heading_links"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    replace_links = build_link_replacer(build_topics(paths))
+
+    for content in converted_contents.values():
+        replace_links(content)
+
+    stage_times["replace_links"] = time.perf_counter() - start
+
+    return stage_times
+
+
+def measure_stages(paths, images_map):
+    """
+    Run each stage on its own over every file in the corpus,
+    to see where the time goes. Holding each stage's output in memory
+    makes this slower than streaming, so its total isn't comparable
+    with the pipeline's.
+    """
+
+    stage_times = Counter()
+    missing_media = []
+    converted_contents = {}
+    heading_slugs = {}
+
+    media_index = timed(
+        stage_times, "media_index", build_media_index, images_map
+    )
+
+    for path in paths:
+        with open(path) as file_handle:
+            lines = timed(stage_times, "read", list, file_handle)
+
+        links = timed(
+            stage_times, "read_links_block", read_links_block, lines
+        )
+
+        lines = timed(stage_times, "strip_style_tags", strip_style_tags, lines)
+        lines = timed(
+            stage_times, "convert_notifications", convert_notifications, lines
+        )
+        title, lines = timed(
+            stage_times, "convert_metadata", convert_metadata, lines
+        )
+        lines = timed(
+            stage_times, "convert_foldouts", convert_foldouts, lines, links
+        )
+        lines = timed(
+            stage_times,
+            "replace_media_urls",
+            replace_media_urls,
+            lines,
+            media_index,
+            missing_media,
+        )
+
+        if use_pandoc:
+            content = timed(stage_times, "run_pandoc", run_pandoc, lines)
+        else:
+            content = "".join(lines)
+
+        content = timed(
+            stage_times, "fix_pandoc_output", fix_pandoc_output, content
+        )
+        content, file_heading_slugs = timed(
+            stage_times, "add_heading_ids", add_heading_ids, content
+        )
+        heading_slugs.update(file_heading_slugs)
+        converted_contents[path] = content
+
+    update_heading_links = timed(
+        stage_times,
+        "build_heading_link_replacer",
+        build_heading_link_replacer,
+        heading_slugs,
+    )
+
+    for path, content in converted_contents.items():
+        converted_contents[path] = timed(
+            stage_times, "update_heading_links", update_heading_links, content
+        )
+
+    replace_links = timed(
+        stage_times,
+        "build_link_replacer",
+        build_link_replacer,
+        build_topics(paths),
+    )
+
+    for content in converted_contents.values():
+        timed(stage_times, "replace_links", replace_links, content)
+
+    return stage_times
+
+
+def measure_in_subprocess(measure, corpus_dir):
+    """
+    Measure a corpus in a fresh process, so its peak memory
+    doesn't include anything measured before it
+    """
+
+    result_path = os.path.join(corpus_dir, f"{measure}-result.json")
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--measure",
+        measure,
+        "--corpus-dir",
+        corpus_dir,
+        "--result-file",
+        result_path,
+    ]
+
+    if not use_pandoc:
+        command.append("--no-pandoc")
+
+    # convert_file prints every file it converts
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+
+    with open(result_path) as result_file:
+        return json.load(result_file)
+
+
+def throughputs(stage_times, file_count, corpus_bytes):
+    """
+    Work out files/s and MB/s for each stage, and print them
+    """
+
+    corpus_mb = corpus_bytes / 1024 / 1024
+    stages = {}
+
+    for stage, seconds in stage_times.items():
+        # Guard against stages too quick for the clock
+        seconds = max(seconds, 1e-9)
+        stages[stage] = {
+            "seconds": round(seconds, 6),
+            "files_per_second": round(file_count / seconds, 1),
+            "mb_per_second": round(corpus_mb / seconds, 3),
+        }
+        print(
+            f"  - {stage}: {seconds:.3f}s "
+            f"({stages[stage]['files_per_second']} files/s, "
+            f"{stages[stage]['mb_per_second']} MB/s)"
+        )
+
+    return stages
+
+
+def compare_results(results, previous_results):
+    """
+    Print how much slower or faster each stage is
+    than in an earlier run with the same corpus sizes
+    """
+
+    previous_runs = {run["files"]: run for run in previous_results["runs"]}
+    previous_commit = previous_results.get("commit") or "the earlier run"
+
+    print(f"\n# Compared to {previous_commit}")
+
+    for run in results["runs"]:
+        previous_run = previous_runs.get(run["files"])
+
+        if not previous_run:
+            continue
+
+        print(f"\n- {run['files']} files:")
+
+        for measure in ["pipeline", "stages"]:
+            for stage, timings in run[measure].items():
+                previous_timings = previous_run.get(measure, {}).get(stage)
+
+                if not previous_timings or not previous_timings["seconds"]:
+                    continue
+
+                ratio = timings["seconds"] / previous_timings["seconds"]
+                print(f"  > {measure} {stage}: {ratio:.2f}x the time")
+
+        if previous_run.get("peak_rss_mb"):
+            ratio = run["peak_rss_mb"] / previous_run["peak_rss_mb"]
+            print(f"  > peak RSS: {ratio:.2f}x the memory")
+
+
+# Measure one corpus, in a process of its own
+# ===
+
+if args.measure:
+    # Media paths are relative to the pages, like in convert.py
+    os.chdir(os.path.join(args.corpus_dir, "en"))
+
+    with open("../uploaded-media.json") as media_file:
+        images_map = json.load(media_file)
+
+    paths = sorted(glob("*.md"))
+
+    if args.measure == "pipeline":
+        stage_times = measure_pipeline(paths, images_map)
+    else:
+        stage_times = measure_stages(paths, images_map)
+
+    stage_times["total"] = sum(stage_times.values())
+
+    with open(args.result_file, "w") as result_file:
+        json.dump(
+            {
+                "seconds": stage_times,
+                "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF),
+                "peak_child_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+            },
+            result_file,
+        )
+
+    sys.exit()
+
+
+# Generate and measure corpora of each size
+# ===
+
+results = {
+    "commit": None,
+    "python": platform.python_version(),
+    "pandoc": bool(use_pandoc),
+    "seed": args.seed,
+    "runs": [],
+}
+
+try:
+    results["commit"] = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        encoding="utf-8",
+        check=True,
+    ).stdout.strip()
+except (OSError, subprocess.CalledProcessError):
+    pass
+
+for file_count in sizes:
+    print(f"\n# Converting {file_count} files")
+
+    with tempfile.TemporaryDirectory(
+        prefix="discoursifier-benchmark-"
+    ) as directory:
+        paths, images_map = generate_corpus(
+            directory, file_count, random.Random(args.seed)
+        )
+        corpus_bytes = sum(os.path.getsize(path) for path in paths)
+
+        media_path = os.path.join(directory, "uploaded-media.json")
+
+        with open(media_path, "w") as media_file:
+            json.dump(images_map, media_file)
+
+        pipeline = measure_in_subprocess("pipeline", directory)
+        stages = measure_in_subprocess("stages", directory)
+
+    print("- Converting every file with convert_file, as convert.py does:")
+    run = {
+        "files": file_count,
+        "bytes": corpus_bytes,
+        "pipeline": throughputs(pipeline["seconds"], file_count, corpus_bytes),
+        "peak_rss_mb": round(pipeline["peak_rss_mb"], 1),
+        "peak_pandoc_rss_mb": round(pipeline["peak_child_rss_mb"], 1),
+    }
+    print(
+        f"  > Peak RSS: {run['peak_rss_mb']} MB, "
+        f"pandoc {run['peak_pandoc_rss_mb']} MB"
+    )
+
+    print("- Each stage on its own:")
+    run["stages"] = throughputs(stages["seconds"], file_count, corpus_bytes)
+    results["runs"].append(run)
+
+if args.output:
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=4)
+
+    print(f"\n> Saved results to {args.output}")
+
+if args.compare:
+    with open(args.compare) as compare_file:
+        compare_results(results, json.load(compare_file))
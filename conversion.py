@@ -0,0 +1,576 @@
+# Standard library
+import hashlib
+import io
+import itertools
+import os
+import re
+import subprocess
+
+# Packages
+import markdown
+
+# Markdown parsers are slow to set up, so each process
+# keeps one of each and resets it between documents
+meta_parser = markdown.Markdown(extensions=["markdown.extensions.meta"])
+foldout_parser = markdown.Markdown()
+
+
+def strip_lines(lines):
+    """
+    Strip leading and trailing whitespace from a stream of lines,
+    like str.strip does for a string
+    """
+
+    lines = iter(lines)
+
+    for line in lines:
+        if line.strip():
+            break
+    else:
+        return
+
+    # Hold back the last line with content, and any blank lines after it,
+    # until we know whether they're at the end
+    last_line = line.lstrip()
+    blank_lines = []
+
+    for line in lines:
+        if line.strip():
+            yield last_line
+            yield from blank_lines
+            last_line = line
+            blank_lines = []
+        else:
+            blank_lines.append(line)
+
+    yield last_line.rstrip()
+
+
+style_pattern = re.compile("<style[^>]*>[^<]*</style>", flags=re.DOTALL)
+
+
+def strip_style_tags(lines):
+    """
+    Remove <style> tags from a stream of lines,
+    only buffering the lines inside a <style> tag
+    """
+
+    style_lines = []
+
+    for line in lines:
+        if not style_lines and "<style" not in line:
+            yield line
+            continue
+
+        style_lines.append(line)
+
+        if "</style>" in line:
+            yield from style_pattern.sub("", "".join(style_lines)).splitlines(
+                True
+            )
+            style_lines = []
+
+    yield from style_pattern.sub("", "".join(style_lines)).splitlines(True)
+
+
+def read_links_block(lines):
+    """
+    Read the reference links after "<!-- LINKS -->" at the end of a file,
+    which foldouts need in order to render their links
+    """
+
+    links_lines = []
+    previous_line = None
+
+    for line in lines:
+        if links_lines:
+            links_lines.append(line)
+        elif previous_line == "\n" and line.startswith("<!-- LINKS -->"):
+            links_lines = ["\n\n", line]
+
+        previous_line = line
+
+    return "".join(links_lines)
+
+
+def convert_foldouts(lines, links=""):
+    """
+    Convert old-style foldouts:
+
+        ^# Summary
+            this is some foldout contents
+
+    Into HTML <details> blocks, rendering their markdown contents along with
+    the reference links from the end of the document ("links").
+
+    Anything after the "<!-- LINKS -->" comment is left as it is.
+    """
+
+    lines = iter(lines)
+    line = next(lines, None)
+    at_start = True
+    after_blank_line = False
+    link_references = None
+
+    while line is not None:
+        if after_blank_line and line.startswith("<!-- LINKS -->"):
+            yield line
+            yield from lines
+            return
+
+        if not (
+            line.startswith("^# ")
+            and re.match(r"\w", line[3:])
+            and line.endswith("\n")
+        ):
+            yield line
+            after_blank_line = line == "\n" and not at_start
+            at_start = False
+            line = next(lines, None)
+            continue
+
+        summary = line[3:-1]
+        foldout_lines = []
+        line = next(lines, None)
+
+        while line is not None and (
+            line == "\n" or (line.startswith(" ") and line.endswith("\n"))
+        ):
+            foldout_lines.append(line)
+            line = next(lines, None)
+
+        if not foldout_lines:
+            yield f"^# {summary}\n"
+            after_blank_line = False
+            at_start = False
+            continue
+
+        # Parse the links once, and share them between all foldouts
+        if link_references is None:
+            foldout_parser.reset()
+            foldout_parser.convert(links)
+            link_references = dict(foldout_parser.references)
+
+        foldout_parser.reset()
+        foldout_parser.references.update(link_references)
+        foldout_html = foldout_parser.convert("".join(foldout_lines))
+
+        if at_start:
+            yield "\n"
+
+        yield "<details>\n"
+        yield f"<summary>{summary}</summary>\n"
+        yield f"{foldout_html}\n"
+        yield "</details>\n"
+
+        # Keep a blank line before the links, or another foldout
+        after_blank_line = foldout_lines[-1] == "\n"
+
+        if after_blank_line and line and line.startswith(
+            ("<!-- LINKS -->", "^# ")
+        ):
+            yield "\n"
+
+        at_start = False
+
+
+notification_pattern = re.compile(
+    "!!! (Note|Warning|Positive|Negative|Important|Tip|Information)"
+    '(?: "([^"]*)")?:?(.*\n)'
+)
+
+
+def convert_notifications(lines):
+    """
+    Convert old-style notifications:
+
+        !!! Note "title":
+            this is some note contents
+
+    Into new style:
+
+        [note="title"]
+        this is some note contents
+        [/note]
+
+    Only the lines of one notification are held in memory at a time.
+    """
+
+    lines = iter(lines)
+    line = next(lines, None)
+
+    while line is not None:
+        match = notification_pattern.search(line)
+
+        if not match:
+            yield line
+            line = next(lines, None)
+            continue
+
+        prefix = line[: match.start()]
+        matched_lines = [line[match.start() :]]
+        line = next(lines, None)
+
+        # Indented lines following the notification are its body
+        while (
+            line is not None
+            and line.startswith("    ")
+            and len(line) > 5
+            and line.endswith("\n")
+        ):
+            matched_lines.append(line)
+            line = next(lines, None)
+
+        note_type = match.group(1).lower()
+        title = match.group(2)
+        body = (match.group(3) + "".join(matched_lines[1:])).strip()
+
+        if note_type in ["warning", "important"]:
+            note_type = "caution"
+
+        if note_type == "tip":
+            note_type = "note"
+
+        if note_type and body:
+            body = re.sub("^    ", "", body).replace("\n    ", "\n")
+
+            options = ""
+
+            if note_type != "note":
+                options = f' type="{note_type}"'
+
+            if title:
+                options = f'{options} status="{title}"'
+
+            yield f"{prefix}[note{options}]\n{body}\n[/note]\n"
+        else:
+            yield prefix
+            yield from matched_lines
+
+
+pandoc_command = [
+    "pandoc",
+    "--atx-headers",
+    "-f",
+    "markdown_mmd+backtick_code_blocks",
+    "-t",
+    (
+        "markdown_mmd+hard_line_breaks+"
+        "backtick_code_blocks+shortcut_reference_links"
+    ),
+]
+
+
+def run_pandoc(lines):
+    """
+    Reformat markdown with pandoc, to remove newlines,
+    writing the lines to it as they are produced
+    """
+
+    process = subprocess.Popen(
+        pandoc_command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        encoding="utf-8",
+    )
+
+    # Pandoc reads all of its input before writing any output,
+    # so we can write everything before we start reading
+    try:
+        with process.stdin:
+            process.stdin.writelines(lines)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+
+    with process.stdout:
+        content = process.stdout.read()
+
+    if process.wait():
+        raise subprocess.CalledProcessError(process.returncode, pandoc_command)
+
+    return content
+
+
+def get_converter_context():
+    """
+    Describe everything besides a file's content that its conversion
+    depends on: the source of this module, the markdown package
+    and pandoc, so cached conversions are only used with the same ones
+    """
+
+    with open(__file__, "rb") as source_file:
+        source_hash = hashlib.sha256(source_file.read()).hexdigest()
+
+    try:
+        pandoc_version = subprocess.run(
+            [pandoc_command[0], "--version"],
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        # Converting will fail anyway, so there's nothing to cache
+        pandoc_version = None
+
+    return {
+        "conversion_source": source_hash,
+        "markdown_version": markdown.version,
+        "pandoc_command": pandoc_command,
+        "pandoc_version": pandoc_version,
+    }
+
+
+def fix_pandoc_output(content):
+    """
+    Unescape characters escaped by pandoc,
+    and put notification tags back on their own lines
+    """
+
+    content = re.sub(r"\\([\[*^`_()$\]#~])", r"\1", content)
+    content = re.sub(r"(\[note[^\]\n]*\]) ", "\\1\n", content)
+
+    return content.replace(" [/note]", "\n[/note]")
+
+
+def convert_metadata(lines):
+    """
+    Convert Markdown metadata
+    (See https://python-markdown.github.io/extensions/meta_data/)
+
+    "Title" will be added as a <h1>, if there isn't one already
+    "TODO" will be preserved in `<!-- -->` HTML comments
+    anything else will be ignored
+
+    Returns the title, and the rest of the lines of the document
+    """
+
+    lines = iter(lines)
+    head_lines = []
+
+    # The metadata ends at the first blank line
+    for line in lines:
+        if line == "\n" and head_lines:
+            break
+
+        head_lines.append(line)
+    else:
+        raise ValueError("No blank line after the metadata")
+
+    head = "".join(head_lines)[:-1]
+    body_lines = strip_lines(lines)
+
+    meta_parser.reset()
+    meta_parser.convert(head)
+    title = meta_parser.Meta.get("title", [None])[0]
+    todo = "\n- ".join(meta_parser.Meta.get("todo", []))
+    first_line = next(body_lines, "")
+    title_match = re.match("^# ([^\n]+)(.*)$", first_line, re.DOTALL)
+
+    if title_match:
+        # Prefer the longer tile
+        if title and len(title_match.groups()[0]) > len(title):
+            title = title_match.groups()[0]
+        body_lines = strip_lines(
+            itertools.chain([title_match.groups()[1]], body_lines)
+        )
+    else:
+        body_lines = itertools.chain([first_line], body_lines)
+
+    def body():
+        if todo:
+            yield from f"<!--\nTodo:\n- {todo}\n-->\n\n".splitlines(True)
+
+        yield from body_lines
+
+    return title, body()
+
+
+def build_media_index(images_map):
+    """
+    Given the list of uploaded media from uploaded-media.json,
+    map the path to each file, relative to here, to its uploaded URL
+    """
+
+    return {
+        os.path.relpath(media["local_filepath"]): media["url"]
+        for media in images_map
+    }
+
+
+def replace_media_urls(lines, media_index, missing_media):
+    """
+    Replace links to local media files with their uploaded URLs,
+    in a single pass over each line.
+
+    Only paths in the media directories, following a "(", '"' or space,
+    are looked at. Any that are referenced but were never uploaded
+    are added to "missing_media"
+    """
+
+    media_directories = {os.path.dirname(path) for path in media_index}
+
+    # Longest first, so a directory never shadows a longer one it prefixes
+    candidates = [
+        re.escape(directory) + "/"
+        for directory in sorted(media_directories, key=len, reverse=True)
+        if directory
+    ]
+
+    # Media right here have no directory to look for, so match their names
+    candidates += [
+        re.escape(path) + r'(?=[\s()"]|$)'
+        for path in sorted(media_index, key=len, reverse=True)
+        if not os.path.dirname(path)
+    ]
+
+    if not candidates:
+        yield from lines
+        return
+
+    media_reference_pattern = re.compile(
+        r'([(" ])((?:' + "|".join(candidates) + r')[^\s()"]*)'
+    )
+
+    def replace_reference(match):
+        delimiter, path = match.groups()
+
+        if path in media_index:
+            return delimiter + media_index[path]
+
+        if os.path.dirname(path) in media_directories:
+            missing_media.append(path)
+
+        return match.group(0)
+
+    for line in lines:
+        yield media_reference_pattern.sub(replace_reference, line)
+
+
+def add_heading_ids(content):
+    """
+    Convert h2-h4 markdown headings into HTML headings with
+    "heading--" IDs, so they have stable anchors in Discourse.
+    Repeated headings in the same file get "-2", "-3" etc. suffixes.
+
+    Returns the new content and a map of old to new heading slugs
+    """
+
+    heading_slugs = {}
+    used_slugs = set()
+
+    def heading_html(match):
+        elem = f"h{len(match.group(1))}"
+        heading_body = match.group(2)
+
+        old_heading_slug = (
+            heading_body.replace(" ", "-").replace("`", "").lower()
+        )
+        new_heading_slug = "heading--" + re.sub(
+            r"[^\w-]", "", old_heading_slug
+        ).strip("-")
+
+        unique_slug = new_heading_slug
+        suffix = 2
+
+        while unique_slug in used_slugs:
+            unique_slug = f"{new_heading_slug}-{suffix}"
+            suffix += 1
+
+        used_slugs.add(unique_slug)
+        heading_slugs.setdefault(old_heading_slug, unique_slug)
+
+        return f'<{elem} id="{unique_slug}">{heading_body}</{elem}>'
+
+    content = re.sub(
+        "^(#{2,4}) (.*)$", heading_html, content, flags=re.MULTILINE
+    )
+
+    return content, heading_slugs
+
+
+def build_heading_link_replacer(heading_slugs):
+    """
+    Given a map of old to new heading slugs, build a function that
+    points links to any of the old slugs at the new heading IDs,
+    in a single pass over the content
+    """
+
+    if not heading_slugs:
+        return lambda content: content
+
+    # Longest slugs first, so a slug never shadows a longer one it prefixes
+    old_heading_slugs = sorted(heading_slugs, key=len, reverse=True)
+    heading_link_pattern = re.compile(
+        "#("
+        + "|".join(re.escape(slug) for slug in old_heading_slugs)
+        + r")([\]\)$])"
+    )
+
+    def update_heading_links(content):
+        return heading_link_pattern.sub(
+            lambda match: (
+                "#" + heading_slugs[match.group(1)] + match.group(2)
+            ),
+            content,
+        )
+
+    return update_heading_links
+
+
+def convert_file(path, media_index, cache=None, use_pandoc=True):
+    """
+    Convert a documentation-builder markdown file for Discourse.
+    This only depends on the file itself, so can run in parallel.
+    Without "use_pandoc", the content isn't reformatted by pandoc,
+    for benchmarking without it.
+
+    Returns the title, the converted content, the slugs of the
+    headings in the file and any referenced media that wasn't uploaded
+    """
+
+    # Read the file once, to hash it for the cache
+    # and to stream it through the stages
+    with open(path, "rb") as source_file:
+        source = source_file.read()
+
+    if cache:
+        cache_key = cache.key(source)
+        cached_result = cache.get(cache_key)
+
+        if cached_result:
+            print(f"- Using cached conversion of {path}")
+            return tuple(cached_result)
+
+    print(f"- Converting {path}")
+
+    # Decoded the way open(path) would, newlines and all
+    source_lines = io.TextIOWrapper(io.BytesIO(source))
+    links = read_links_block(source_lines)
+    source_lines.seek(0)
+
+    # Each stage is a generator, so no copy of the whole document
+    # is made until pandoc's output
+    missing_media = []
+    lines = strip_style_tags(source_lines)
+    lines = convert_notifications(lines)
+    title, lines = convert_metadata(lines)
+    lines = convert_foldouts(lines, links)
+    lines = replace_media_urls(lines, media_index, missing_media)
+
+    # Reformat with pandoc, then tidy up after it
+    if use_pandoc:
+        content = run_pandoc(lines)
+    else:
+        content = "".join(lines)
+
+    content = fix_pandoc_output(content)
+
+    content, heading_slugs = add_heading_ids(content)
+    result = (title, content, heading_slugs, missing_media)
+
+    if cache:
+        cache.set(cache_key, result)
+
+    return result
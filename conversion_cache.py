@@ -0,0 +1,96 @@
+# Standard library
+import hashlib
+import json
+import os
+
+# Local imports
+from helpers import write_file_atomically
+
+
+class ConversionCache:
+    """
+    An on-disk cache of converted files, keyed on the source content
+    and everything else the conversion depends on ("context").
+
+    Least recently used entries are evicted when the cache
+    grows beyond "max_size" bytes.
+    """
+
+    def __init__(self, directory, context, max_size=200 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.context_hash = hashlib.sha256(
+            json.dumps(context, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, source):
+        """
+        Get the cache key for converting a file's content ("source", bytes)
+        """
+
+        source_hash = hashlib.sha256(self.context_hash.encode("utf-8"))
+        source_hash.update(source)
+
+        return source_hash.hexdigest()
+
+    def get(self, key):
+        """
+        Get a cached conversion result, or None
+        """
+
+        entry_path = self._entry_path(key)
+
+        try:
+            with open(entry_path) as entry_file:
+                result = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+        # Mark as recently used
+        os.utime(entry_path)
+
+        return result
+
+    def set(self, key, result):
+        """
+        Store a conversion result
+        """
+
+        write_file_atomically(self._entry_path(key), json.dumps(result))
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache
+        is no bigger than max_size. Returns the number removed.
+        """
+
+        entries = []
+
+        with os.scandir(self.directory) as directory_entries:
+            for entry in directory_entries:
+                if entry.name.endswith(".json"):
+                    entry_stat = entry.stat()
+                    entries.append(
+                        (entry_stat.st_mtime, entry_stat.st_size, entry.path)
+                    )
+
+        total_size = sum(size for _, size, _ in entries)
+        removed = 0
+
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            os.remove(entry_path)
+            total_size -= size
+            removed += 1
+
+        return removed
+
+    # Private methods
+    # ===
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
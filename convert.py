@@ -1,281 +1,171 @@
 #! /usr/bin/env python3
 
-from glob import glob
-import markdown
-import os
-import re
+# Standard library
+import argparse
 import json
-import subprocess
-
-filepaths = glob("**/*.md", recursive=True)
-
-
-def convert_foldouts(content):
-    links = ""
-    body_links = content.split("\n\n<!-- LINKS -->")
-
-    if len(body_links) > 1:
-        content = body_links[0]
-        links = "\n\n<!-- LINKS -->" + body_links[1]
-
-    sections = re.split("(?:^|\n)\^# ", content)
-
-    new_content = ""
-
-    for index, section in enumerate(sections):
-        if index == 0:
-            new_content = section
-            continue
-
-        foldout_match = re.match(
-            "^(\w.*)\n((?: +.*\n|\n)+)((?:.|\n)*$)", section
-        )
-
-        summary = foldout_match.groups()[0]
-        foldout_body = foldout_match.groups()[1]
-        remainder = foldout_match.groups()[2]
-
-        foldout_html = markdown.markdown(foldout_body + links)
-
-        new_content += (
-            f"\n<details>\n<summary>{summary}</summary>"
-            f"\n{foldout_html}\n</details>\n{remainder}"
-        )
-
-    return new_content + links
-
-
-def convert_notifications(content):
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# Local imports
+from conversion import (
+    build_heading_link_replacer,
+    build_media_index,
+    convert_file,
+    get_converter_context,
+)
+from conversion_cache import ConversionCache
+from helpers import find_markdown_files, write_file_atomically
+
+
+def main():
     """
-    Convert old-style notifications:
-
-        !!! Note "title":
-            this is some note contents
-
-    Into new style:
-
-        [note="title"]
-        this is some note contents
-        [/note]
+    Convert every markdown file here. This is only run as a script,
+    not when --jobs workers import this module to convert files.
     """
 
-    notification_match = (
-        "!!! (Note|Warning|Positive|Negative|Important|Tip|Information)"
-        '(?: "([^"]*)")?:?(.*\n(?:    .+\n)*)'
+    # Arguments
+    parser = argparse.ArgumentParser(
+        description=(
+            "Convert documentation-builder Markdown files for Discourse"
+        )
     )
 
-    for match in re.finditer(notification_match, content):
-        matched_text = match.group(0)
-        note_type = match.group(1).lower()
-        title = match.group(2)
-        body = match.group(3).strip()
-
-        if note_type in ["warning", "important"]:
-            note_type = "caution"
-
-        if note_type == "tip":
-            note_type = "note"
-
-        if note_type and body:
-            body = re.sub("^    ", "", body).replace("\n    ", "\n")
-
-            options = ""
-
-            if note_type != "note":
-                options = f' type="{note_type}"'
-
-            if title:
-                options = f'{options} status="{title}"'
-
-            replacement = f"[note{options}]\n{body}\n[/note]\n"
-
-            content = content.replace(matched_text, replacement)
-
-    return content
-
-
-def convert_metadata(content):
-    """
-    Convert Markdown metadata
-    (See https://python-markdown.github.io/extensions/meta_data/)
-
-    "Title" will be added as a <h1>, if there isn't one already
-    "TODO" will be preserved in `<!-- -->` HTML comments
-    anything else will be ignored
-    """
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help=("Number of files to convert in parallel"),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.path.expanduser("~/.cache/discoursifier"),
+        help=(
+            "Where to keep converted files, to reuse if they haven't changed"
+        ),
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=200,
+        help=("Maximum size of the cache, in MB"),
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help=("Convert every file again")
+    )
+    parser.add_argument(
+        "--out-dir",
+        default=".",
+        help=(
+            "Write the converted files, title-map.json and heading-slugs.json "
+            "here, instead of over the source files"
+        ),
+    )
 
-    head, body = content.split("\n\n", 1)
+    args = parser.parse_args()
 
-    body = body.strip()
+    out_dir = os.path.abspath(args.out_dir)
 
-    parser = markdown.Markdown(extensions=["markdown.extensions.meta"])
-    parser.convert(head)
-    title = parser.Meta.get("title", [None])[0]
-    todo = "\n- ".join(parser.Meta.get("todo", []))
-    title_match = re.match("^# ([^\n]+)(.*)$", body, re.DOTALL)
+    # Sorted, so the title and slug maps are merged
+    # in the same order every time
+    filepaths = find_markdown_files(out_dir)
 
-    if title_match:
-        # Prefer the longer tile
-        if title and len(title_match.groups()[0]) > len(title):
-            title = title_match.groups()[0]
-        body = title_match.groups()[1].strip()
+    if not filepaths:
+        # Don't replace the existing maps with empty ones
+        sys.exit("No markdown files to convert")
 
-    if todo:
-        body = f"<!--\nTodo:\n- {todo}\n-->\n\n" + body
+    title_map = {}
+    converted_contents = {}
+    missing_media = {}
 
-    return title, body
+    with open('uploaded-media.json') as media_json:
+        media_index = build_media_index(json.load(media_json))
 
+    heading_slugs = {}
+    heading_slugs_path = os.path.join(out_dir, "heading-slugs.json")
 
-title_map = {}
+    if os.path.isfile(heading_slugs_path):
+        with open(heading_slugs_path) as heading_slugs_handle:
+            heading_slugs = json.load(heading_slugs_handle)
 
-with open('uploaded-media.json') as media_json:
-    images_map = json.load(media_json)
+    # Convert markdown
+    # ===
 
-# Convert markdown
-# ===
+    print("\n# Converting Markdown content")
 
-print("\n# Converting Markdown content")
+    cache = None
 
-for path in filepaths:
-    print(f"- Converting {path}")
+    if not args.no_cache:
+        cache = ConversionCache(
+            directory=args.cache_dir,
+            context=dict(get_converter_context(), media_index=media_index),
+            max_size=args.cache_size * 1024 * 1024,
+        )
 
-    with open(path) as file_handle:
-        content = file_handle.read()
+    convert = partial(convert_file, media_index=media_index, cache=cache)
 
-    # Remove <style> tags
-    content = re.sub("<style[^>]*>[^<]*</style>", "", content, flags=re.DOTALL)
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(convert, filepaths))
+    else:
+        results = list(map(convert, filepaths))
 
-    content = convert_notifications(content)
-    title, content = convert_metadata(content)
-    content = convert_foldouts(content)
+    if cache:
+        evicted_count = cache.evict()
 
-    # Replace image URLs
-    for media in images_map:
-        relative_path = os.path.relpath(media['local_filepath'])
-        content = content.replace(f"({relative_path})", f"({media['url']})")
-        content = content.replace(f'"{relative_path}"', f'"{media["url"]}"')
-        content = content.replace(f' {relative_path}', f' {media["url"]}')
+        if evicted_count:
+            print(f"\n> Evicted {evicted_count} old entries from the cache")
 
-    title_map[path] = title
+    for path, result in zip(filepaths, results):
+        title, content, file_heading_slugs, file_missing_media = result
+        title_map[path] = title
+        heading_slugs.update(file_heading_slugs)
+        converted_contents[path] = content
 
-    with open(path, "w") as file_handle:
-        file_handle.write(content)
+        if file_missing_media:
+            missing_media[path] = file_missing_media
 
-print("\n> Writing to title-map.json")
+    if missing_media:
+        print("\n> Media referenced but not uploaded:")
 
-# Write title mapping to file
-with open("title-map.json", "w") as title_map_file:
-    json.dump(title_map, title_map_file, indent=4, sort_keys=True)
+        for path, media_paths in missing_media.items():
+            for media_path in media_paths:
+                print(f"  - {media_path} (in {path})")
 
-print("\n> Running pandoc transformations")
+    print("\n> Writing to title-map.json")
 
-for path in filepaths:
-    # Reformat file to remove newlines
-    subprocess.check_call(
-        [
-            "pandoc",
-            "--atx-headers",
-            "-f",
-            "markdown_mmd+backtick_code_blocks",
-            "-t",
-            (
-                "markdown_mmd+hard_line_breaks+"
-                "backtick_code_blocks+shortcut_reference_links"
-            ),
-            path,
-            "-o",
-            path,
-        ]
+    # Write title mapping to file
+    write_file_atomically(
+        os.path.join(out_dir, "title-map.json"),
+        json.dumps(title_map, indent=4, sort_keys=True),
     )
 
-    # Unescape characters escaped by Pandoc
-    subprocess.check_call(
-        [
-            "sed",
-            "-i",
-            "-E",
-            r"s!\\(\[|\*|\^|`|_|[(]|[)]|\$|\]|#|~)!\1!g",
-            path,
-        ]
-    )
+    # Upload needs the navigation alongside the converted files
+    if out_dir != os.path.abspath(".") and os.path.isfile("metadata.yaml"):
+        with open("metadata.yaml") as metadata_file:
+            write_file_atomically(
+                os.path.join(out_dir, "metadata.yaml"), metadata_file.read()
+            )
 
-    # Add notifications around notification blocks
-    subprocess.check_call(
-        ["sed", "-i", "-E", r"s!(\[note[^]]*\]) !\1\n!g", path]
-    )
-    subprocess.check_call(
-        ["sed", "-i", "-E", r's! \[/note\]!\n[/note]!g', path]
-    )
+    # Update the heading links, and write out the converted files
+    # ===
 
-# Add header IDs
-# ===
+    print("\n> Updating heading links")
 
-print("\n> Adding heading markup")
+    update_heading_links = build_heading_link_replacer(heading_slugs)
 
-heading_slugs = {}
-
-if os.path.isfile("heading-slugs.json"):
-    with open("heading-slugs.json") as heading_slugs_handle:
-        heading_slugs = json.load(heading_slugs_handle)
-
-for path in filepaths:
-    with open(path) as read_handle:
-        content = read_handle.read()
-
-    headings = re.findall("(^#{2,4} .*)", content, flags=re.MULTILINE)
-
-    for heading in headings:
-        elem = None
-        heading_body = ""
-
-        if heading[:3] == "## ":
-            elem = "h2"
-            heading_body = heading[3:]
-        elif heading[:4] == "### ":
-            elem = "h3"
-            heading_body = heading[4:]
-        elif heading[:5] == "#### ":
-            elem = "h4"
-            heading_body = heading[5:]
-
-        old_heading_slug = (
-            heading_body.replace(" ", "-").replace("`", "").lower()
-        )
-        new_heading_slug = "heading--" + re.sub(
-            r"[^\w-]", "", old_heading_slug
-        ).strip("-")
-
-        heading_slugs[old_heading_slug] = new_heading_slug
-
-        heading_html = (
-            f'<{elem} id="{new_heading_slug}">{heading_body}</{elem}>'
+    for path, content in converted_contents.items():
+        write_file_atomically(
+            os.path.join(out_dir, path), update_heading_links(content)
         )
-        content = re.sub(
-            f"^{re.escape(heading)}$",
-            heading_html,
-            content,
-            flags=re.MULTILINE,
-        )
-
-    with open(path, "w") as write_handle:
-        write_handle.write(content)
 
-# Now update the heading links
-for path in filepaths:
-    for old_heading_slug, new_heading_slug in heading_slugs.items():
-        with open(path) as read_handle:
-            content = read_handle.read()
+    print("\n> Writing to heading-slugs.json")
 
-        content = re.sub(
-            "#" + re.escape(old_heading_slug) + r"([\]\)$])",
-            "#" + new_heading_slug + r"\1",
-            content,
-        )
-
-        with open(path, "w") as write_handle:
-            write_handle.write(content)
+    write_file_atomically(
+        heading_slugs_path, json.dumps(heading_slugs, indent=4, sort_keys=True)
+    )
 
-print("\n> Writing to heading-slugs.json")
 
-with open("heading-slugs.json", "w") as heading_slugs_handle:
-    json.dump(heading_slugs, heading_slugs_handle, indent=4, sort_keys=True)
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,19 @@
 
 # Standard packages
 import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Local imports
 from discourse_api import DiscourseAPI
+from helpers import get_created_topics, save_created_topics, save_metrics
 
 # Arguments
 parser = argparse.ArgumentParser(
-    description=("Upload Markdown documents to a Discourse installation")
+    description=("Delete all topics in a Discourse category")
 )
 
 parser.add_argument("--api-key", required=True)
@@ -17,6 +23,40 @@ parser.add_argument("--api-username", default="system")
 parser.add_argument(
     "--category", default="docs", help=("Category for created posts")
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help=("Number of topics to delete concurrently"),
+)
+parser.add_argument(
+    "--journal",
+    default="deleted-topics.log",
+    help=(
+        "File to record each deleted topic in, so an interrupted run "
+        "can carry on where it left off (removed once every topic is deleted)"
+    ),
+)
+parser.add_argument(
+    "--prune-created-topics",
+    action="store_true",
+    help=("Remove deleted topics from created-topics.json"),
+)
+parser.add_argument(
+    "--max-rate",
+    type=float,
+    help=(
+        "Most API requests per second to send "
+        "(the rate is also learned from the API's 429 responses)"
+    ),
+)
+parser.add_argument(
+    "--metrics-file",
+    help=(
+        "Save API request metrics to this file, as JSON, "
+        "or in Prometheus textfile format if it ends in .prom"
+    ),
+)
 
 args = parser.parse_args()
 
@@ -25,17 +65,116 @@ api = DiscourseAPI(
     username=args.api_username,
     key=args.api_key,
     category_name=args.category,
+    pool_size=args.workers,
+    max_rate=args.max_rate,
 )
 
-category_topics = api.get_category_topics()
+# Topics deleted by previous runs, against the same API and category
+journal_scope = {"url": api.url, "category": args.category}
+deleted_ids = set()
+
+if os.path.isfile(args.journal):
+    with open(args.journal) as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+
+            scope = {key: entry.get(key) for key in journal_scope}
+
+            if scope == journal_scope:
+                deleted_ids.add(entry["id"])
+
+# The category's own "About" topic can't be deleted
+about_topic_url = api.category.get("topic_url") or ""
+
+print("- Listing all topics in the category")
+topic_ids = [
+    topic["id"]
+    for topic in api.iter_category_topics(fields=["id"])
+    if topic["id"] not in deleted_ids
+    and not about_topic_url.endswith(f"/{topic['id']}")
+]
+
+print(f"- Deleting {len(topic_ids)}")
+
+# Workers finish concurrently, so all changes to the journal
+# and progress happen under this lock
+journal_lock = threading.Lock()
+start_time = time.monotonic()
+finished_count = 0
+failed_count = 0
+
+
+def delete_topic(topic_id, journal_file):
+    """
+    Delete a topic, recording it in the journal if it's now gone,
+    and report progress
+    """
+
+    global finished_count, failed_count
+
+    response = api.delete_topic(topic_id)
+    deleted = response.ok or response.status_code == 404
+
+    with journal_lock:
+        if deleted:
+            deleted_ids.add(topic_id)
+            journal_file.write(json.dumps(dict(journal_scope, id=topic_id)))
+            journal_file.write("\n")
+            journal_file.flush()
+        else:
+            failed_count += 1
+
+        finished_count += 1
+        rate = finished_count / (time.monotonic() - start_time)
+        print(
+            f"- [{finished_count}/{len(topic_ids)}] "
+            f"{'Deleted' if deleted else 'Failed to delete'} "
+            f"topic {topic_id} ({rate:.1f} topics/second)"
+        )
+
+
+with open(args.journal, "a") as journal_file:
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(
+            executor.map(
+                delete_topic,
+                topic_ids,
+                [journal_file] * len(topic_ids),
+            )
+        )
+
+if topic_ids:
+    elapsed = time.monotonic() - start_time
+    print(
+        f"- Finished {len(topic_ids)} topics in {elapsed:.1f} seconds "
+        f"({len(topic_ids) / elapsed:.1f} topics/second)"
+    )
+
+# Nothing is left to carry on with
+if not failed_count:
+    os.remove(args.journal)
+
+if args.prune_created_topics:
+    created_topics = get_created_topics()
+    deleted_paths = [
+        path
+        for path, topic_info in created_topics.items()
+        if topic_info["id"] in deleted_ids
+    ]
+
+    for path in deleted_paths:
+        del created_topics[path]
 
-while len(category_topics) > 1:
-    print(f"- Deleting {len(category_topics)}")
+    print(f"- Removing {len(deleted_paths)} topics from created-topics.json")
+    save_created_topics(created_topics)
 
-    for topic in category_topics:
-        api.delete_topic(topic["id"])
+api.metrics.print_summary()
 
-    print("- Getting topics again, to check we deleted them all")
-    category_topics = api.get_category_topics()
+if args.metrics_file:
+    save_metrics(api.metrics, args.metrics_file)
 
 api.print_errors()
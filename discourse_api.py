@@ -1,20 +1,202 @@
 # Core packages
+import collections
+import random
 import re
 import requests
+import threading
 import time
+from requests.adapters import HTTPAdapter
+
+# Local imports
+from metrics import Metrics
+
+
+class RateLimiter:
+    """
+    Paces requests from every thread calling the API,
+    to stay just below the rate the server allows.
+
+    The rate starts at "max_rate" (or unlimited). Each 429 pauses
+    all requests, and lowers the rate to just below what we had been
+    sending at. Each success raises the rate again, a little at a time.
+    """
+
+    def __init__(self, max_rate=None, min_rate=0.1, window=60):
+        self.rate = max_rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.window = window
+        self._lock = threading.Lock()
+        self._resume_at = 0
+        self._next_send_at = 0
+        self._sent_times = collections.deque()
+
+    def wait(self):
+        """
+        Block until the next request may be sent,
+        and return how many seconds we waited
+        """
+
+        started = time.monotonic()
+
+        with self._lock:
+            send_at = max(started, self._resume_at)
+
+            if self.rate:
+                send_at = max(send_at, self._next_send_at)
+                self._next_send_at = send_at + 1 / self.rate
+
+        time.sleep(max(0, send_at - started))
+
+        # Another request may have been told to back off while we waited
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                delay = self._resume_at - now
+
+                if delay <= 0:
+                    self._sent_times.append(now)
+
+                    while self._sent_times[0] < now - self.window:
+                        self._sent_times.popleft()
+
+                    break
+
+            time.sleep(delay)
+
+        return time.monotonic() - started
+
+    def back_off(self, seconds):
+        """
+        Pause all requests for (at least) this many seconds,
+        and slow down to just below the rate we were sending at
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._resume_at = max(self._resume_at, now + seconds)
+            self._next_send_at = max(self._next_send_at, self._resume_at)
+
+            if len(self._sent_times) > 1:
+                sent_rate = len(self._sent_times) / max(
+                    now - self._sent_times[0], 1
+                )
+                self.rate = max(self.min_rate, sent_rate * 0.9)
+
+    def learn_from_headers(self, headers):
+        """
+        Set the rate from rate limit headers, if the server sends them
+        """
+
+        remaining = headers.get(
+            "X-RateLimit-Remaining", headers.get("RateLimit-Remaining")
+        )
+        reset = headers.get(
+            "X-RateLimit-Reset", headers.get("RateLimit-Reset")
+        )
+
+        if not (remaining and reset):
+            return
+
+        try:
+            remaining = float(remaining)
+            reset_seconds = float(reset)
+        except ValueError:
+            return
+
+        # X-RateLimit-Reset is usually the epoch time the limit resets at,
+        # rather than the seconds until then
+        if reset_seconds > 24 * 60 * 60:
+            reset_seconds -= time.time()
+
+        reset_seconds = max(reset_seconds, 1)
+
+        with self._lock:
+            # Nothing left: wait for the reset, rather than slowing down
+            if remaining < 1:
+                now = time.monotonic()
+                self._resume_at = max(self._resume_at, now + reset_seconds)
+                self._next_send_at = max(self._next_send_at, self._resume_at)
+                return
+
+            self.rate = max(self.min_rate, remaining / reset_seconds * 0.95)
+
+            if self.max_rate:
+                self.rate = min(self.rate, self.max_rate)
+
+    def succeeded(self):
+        """
+        Speed up a little after a successful request
+        """
+
+        with self._lock:
+            if self.rate:
+                self.rate *= 1.01
+
+                if self.max_rate:
+                    self.rate = min(self.rate, self.max_rate)
 
 
 class DiscourseAPI:
     _errors = []
 
-    def __init__(self, url, username, key, category_name):
+    def __init__(
+        self,
+        url,
+        username,
+        key,
+        category_name,
+        pool_size=10,
+        timeout=30,
+        retries=5,
+        max_rate=None,
+    ):
+        """
+        - pool_size: How many connections to keep open to the server
+          (should be at least the number of threads using the client)
+        - timeout: Seconds to wait to connect to, or hear back from, the server
+        - retries: How many times to retry a request after a 429,
+          or after a 5xx or connection error for idempotent requests,
+          or after failing to connect for any request
+        - max_rate: The most requests per second to send, if limited
+        """
+
         self.url = url
         self.username = username
         self.key = key
+        self.timeout = timeout
+        self.retries = retries
+        self.rate_limiter = RateLimiter(max_rate=max_rate)
+
+        self.metrics = Metrics()
+
+        # The ID of the first post in each topic, by topic ID
+        self.post_ids = {}
+
+        # Share keep-alive connections between all calls
+        self.session = requests.Session()
+        self.session.headers.update(
+            {"Api-Key": self.key, "Api-Username": self.username}
+        )
+        # _call_api does all the retrying, so it's paced and counted
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
         print(f"- Getting ID for category {category_name}")
-        category_info = requests.get(f"{self.url}/c/{category_name}/show.json")
-        self.category = category_info.json()["category"]
+        category_response = self._call_api(
+            message=f"Getting category {category_name}",
+            operation="category",
+            method="GET",
+            url_path=f"/c/{category_name}/show.json",
+        )
+
+        # Nothing else can be done without the category
+        category_response.raise_for_status()
+
+        self.category = category_response.json()["category"]
         print(f"  > ID: {self.category['id']}")
 
     def get_category_topics(self):
@@ -22,33 +204,73 @@ class DiscourseAPI:
         Get all topics in the chosen category
         """
 
-        category_data = self._call_api(
-            message=f"Getting category {self.category['id']}",
-            method=requests.get,
-            url_path=f"/c/{self.category['id']}.json"
-        )
-        return category_data.json()["topic_list"]["topics"]
+        return list(self.iter_category_topics())
+
+    def iter_category_topics(self, page_size=None, fields=None):
+        """
+        Iterate through all topics in the chosen category,
+        one page at a time, following each page's "more_topics_url"
+        - page_size: How many topics to get per page
+        - fields: Only include these fields for each topic
+
+        Raises requests.HTTPError if a page can't be fetched,
+        so callers never mistake part of the category for all of it
+        """
+
+        url_path = f"/c/{self.category['id']}.json"
+        params = {"per_page": page_size} if page_size else {}
+        page = 0
+
+        while url_path:
+            response = self._call_api(
+                message=(
+                    f"Getting page {page} of category {self.category['id']}"
+                ),
+                operation="list",
+                method="GET",
+                url_path=url_path,
+                extra_data=params,
+            )
+
+            response.raise_for_status()
+
+            topic_list = response.json()["topic_list"]
+
+            for topic in topic_list["topics"]:
+                if fields:
+                    topic = {field: topic.get(field) for field in fields}
+
+                yield topic
+
+            url_path = None
+            more_topics_url = topic_list.get("more_topics_url")
+
+            if more_topics_url and topic_list["topics"]:
+                url_path = self._json_url_path(more_topics_url)
+                page += 1
 
     def get_topic_markdown(self, topic_id):
         """
-        Given a topic_id, get the markdown in the top post
+        Given a topic_id, get the markdown in the top post,
+        or None if the topic couldn't be fetched
         """
 
         post = self._get_post_from_topic(topic_id)
 
-        return post["raw"]
+        return post and post["raw"]
 
     def create_topic(self, title, markdown):
         """
         Create a new topic
         """
 
-        return self._call_api(
+        response = self._call_api(
             message=(
                 f"creating topic '{title}'' "
                 f"in category '{self.category['name']}'"
             ),
-            method=requests.post,
+            operation="create",
+            method="POST",
             url_path=f"/posts.json",
             extra_data={
                 "title": title,
@@ -57,44 +279,71 @@ class DiscourseAPI:
             },
         )
 
+        if response.ok:
+            self.post_ids[response.json()["topic_id"]] = response.json()["id"]
+
+        return response
+
     def delete_topic(self, id):
         """
         Delete a topic by its ID
         """
 
-        return self._call_api(
+        response = self._call_api(
             message=(
                 f"deleting topic {id} in category '{self.category['name']}'"
             ),
-            method=requests.delete,
+            operation="delete",
+            method="DELETE",
             url_path=f"/t/{id}.json",
+            expected_errors=[404],
         )
 
+        # 404 means it's already gone
+        if response.ok or response.status_code == 404:
+            self.post_ids.pop(id, None)
+
+        return response
+
     def update_topic_content(self, topic_id, markdown):
         """
-        Update raw Markdown content in the specified post
+        Update raw Markdown content in the specified post,
+        or return None if its first post can't be found
         """
 
-        post = self._get_post_from_topic(topic_id)
+        post_id = self._get_post_id(topic_id)
+
+        if post_id is None:
+            return self._skip_missing_post(
+                f"updating markdown in topic {topic_id}"
+            )
 
         return self._call_api(
-            message=f"updating markdown in post {post['id']}",
-            method=requests.put,
-            url_path=f"/posts/{post['id']}.json",
+            message=f"updating markdown in post {post_id}",
+            operation="update",
+            method="PUT",
+            url_path=f"/posts/{post_id}.json",
             extra_data={"post[raw]": markdown},
         )
 
     def convert_topic_to_wiki(self, topic_id):
         """
-        Convert topic to wiki
+        Convert topic to wiki,
+        or return None if its first post can't be found
         """
 
-        post = self._get_post_from_topic(topic_id)
+        post_id = self._get_post_id(topic_id)
+
+        if post_id is None:
+            return self._skip_missing_post(
+                f"converting topic {topic_id} to Wiki"
+            )
 
         return self._call_api(
-            message=f"converting post {post['id']} in topic {topic_id} to Wiki",
-            method=requests.put,
-            url_path=f"/posts/{post['id']}/wiki",
+            message=f"converting post {post_id} in topic {topic_id} to Wiki",
+            operation="wiki",
+            method="PUT",
+            url_path=f"/posts/{post_id}/wiki",
             extra_data={"wiki": True},
         )
 
@@ -113,57 +362,227 @@ class DiscourseAPI:
     # Private methods
     # ===
 
-    def _call_api(self, message, method, url_path, extra_data={}):
+    def _call_api(
+        self,
+        message,
+        operation,
+        method,
+        url_path,
+        extra_data={},
+        expected_errors=[],
+    ):
         """
         Call the Discourse API
-        - request_callback: e.g. requests.get
+        - operation: What the call is for, for metrics, e.g. "create"
+        - method: The HTTP method, e.g. "GET"
+        - extra_data: Sent as query parameters for GET requests,
+          or as the form body otherwise
+        - expected_errors: Error status codes the caller will handle,
+          so which shouldn't be recorded as errors
         """
 
-        response = None
-        data = {"api_key": self.key, "api_username": self.username}
-
-        data.update(extra_data)
-
-        while response is None or response.status_code == 429:
-            if response is not None and response.status_code == 429:
-                seconds = 5
-                error_message = response.json()["errors"][0]
-                seconds_match = re.search("wait (\d+) seconds", error_message)
+        endpoint = self._endpoint(method, url_path)
+        data_argument = "params" if method == "GET" else "data"
 
-                if seconds_match:
-                    seconds = int(seconds_match.groups()[0]) + 1
+        # A POST which may have reached the server mustn't be sent twice,
+        # but it's safe to retry if it couldn't connect at all
+        idempotent = method != "POST"
+        attempt = 0
 
-                print(
-                    f"  > 429 from API, waiting {seconds} seconds ... "
-                    f"('{response.json()['errors']}')"
+        while True:
+            self.metrics.record_wait(
+                operation, endpoint, self.rate_limiter.wait()
+            )
+            print(f"  > {message[0].upper()}{message[1:]} ...")
+            sent_at = time.monotonic()
+
+            try:
+                response = self.session.request(
+                    method,
+                    self.url + url_path,
+                    timeout=self.timeout,
+                    **{data_argument: extra_data},
+                )
+            except (requests.ConnectionError, requests.Timeout) as error:
+                self.metrics.record_request(
+                    operation,
+                    endpoint,
+                    latency=time.monotonic() - sent_at,
+                    ok=False,
+                    bytes_sent=0,
+                    bytes_received=0,
                 )
-                time.sleep(seconds)
 
-            print(f"  > {message[0].upper()}{message[1:]} ...")
-            response = method(self.url + url_path, data=data)
+                never_sent = isinstance(error, requests.ConnectTimeout)
+
+                if not (idempotent or never_sent) or attempt >= self.retries:
+                    raise
+
+                retry_reason = type(error).__name__
+            else:
+                # Count bytes, not characters, of text bodies
+                body = response.request.body or b""
+
+                if isinstance(body, str):
+                    body = body.encode("utf-8")
+
+                self.metrics.record_request(
+                    operation,
+                    endpoint,
+                    latency=time.monotonic() - sent_at,
+                    ok=(
+                        response.ok
+                        or response.status_code in expected_errors + [429]
+                    ),
+                    bytes_sent=len(body),
+                    bytes_received=len(response.content),
+                )
+                self.rate_limiter.learn_from_headers(response.headers)
+
+                if response.status_code == 429:
+                    self.metrics.record_rate_limited(operation, endpoint)
+
+                if response.status_code == 429 and attempt < self.retries:
+                    seconds = self._get_retry_seconds(response)
+                    print(
+                        f"  > 429 from API, waiting {seconds} seconds ... "
+                        f"('{self._get_error_messages(response)}')"
+                    )
+                    self.rate_limiter.back_off(seconds)
+                    attempt += 1
+                    continue
+
+                if not (
+                    response.status_code >= 500
+                    and idempotent
+                    and attempt < self.retries
+                ):
+                    break
+
+                retry_reason = f"Error {response.status_code}"
+
+            # Exponential back-off, with jitter so threads don't retry together
+            delay = min(60, 2 ** attempt) * random.uniform(0.5, 1)
+            print(
+                f"  > {retry_reason} {message}, "
+                f"retrying in {delay:.1f} seconds ..."
+            )
+            time.sleep(delay)
+            self.metrics.record_retry(operation, endpoint)
+            self.metrics.record_wait(operation, endpoint, delay)
+            attempt += 1
 
         if response.ok:
+            self.rate_limiter.succeeded()
             print(f"  > Success {message}")
+        elif response.status_code in expected_errors:
+            print(f"  > {response.status_code} {message}")
         else:
             error_message = (
                 f"Error {response.status_code} {message}: "
-                f"{response.json()['errors']}"
+                f"{self._get_error_messages(response)}"
             )
             print(f"  > {error_message}")
             self._errors.append(error_message)
 
         return response
 
+    def _endpoint(self, method, url_path):
+        """
+        Name the endpoint a request is for, e.g. "PUT /posts/{id}.json"
+        """
+
+        path = re.sub(r"/\d+", "/{id}", url_path.partition("?")[0])
+
+        return f"{method} {path}"
+
+    def _get_retry_seconds(self, response):
+        """
+        Given a 429 response, work out how many seconds to wait,
+        from its Retry-After header or its "wait N seconds" message
+        """
+
+        retry_after = response.headers.get("Retry-After", "")
+
+        if retry_after.isdigit():
+            return int(retry_after) + 1
+
+        seconds_match = re.search(
+            r"wait (\d+) seconds", self._get_error_messages(response)
+        )
+
+        if seconds_match:
+            return int(seconds_match.groups()[0]) + 1
+
+        return 5
+
+    def _get_error_messages(self, response):
+        """
+        Get the error messages from a failed response,
+        which may not be JSON if it didn't come from Discourse
+        """
+
+        try:
+            return str(response.json()["errors"])
+        except (ValueError, KeyError, TypeError):
+            return response.text[:200]
+
+    def _json_url_path(self, url_path):
+        """
+        Given a path to a Discourse page, e.g. "/c/docs/5/l/latest?page=1",
+        get the path to its JSON version, e.g. "/c/docs/5/l/latest.json?page=1"
+        """
+
+        path, question_mark, query = url_path.partition("?")
+
+        if not path.endswith(".json"):
+            path += ".json"
+
+        return path + question_mark + query
+
     def _get_post_from_topic(self, topic_id):
         """
-        Given a topic ID, get the data about the first post
+        Given a topic ID, get the data about the first post,
+        or None if the topic couldn't be fetched
         """
 
         get_response = self._call_api(
             message=f"Getting topic {topic_id}",
-            method=requests.get,
+            operation="fetch",
+            method="GET",
             url_path=f"/t/{topic_id}.json",
             extra_data={"include_raw": "1"},
         )
 
-        return get_response.json()["post_stream"]["posts"][0]
+        if not get_response.ok:
+            return None
+
+        post = get_response.json()["post_stream"]["posts"][0]
+        self.post_ids[topic_id] = post["id"]
+
+        return post
+
+    def _get_post_id(self, topic_id):
+        """
+        Given a topic ID, get the ID of its first post,
+        only asking the API if we don't already know it,
+        or None if the topic couldn't be fetched
+        """
+
+        if topic_id not in self.post_ids:
+            self._get_post_from_topic(topic_id)
+
+        return self.post_ids.get(topic_id)
+
+    def _skip_missing_post(self, message):
+        """
+        Record that we couldn't do something to a topic
+        because we couldn't find its first post
+        (e.g. because the topic was deleted)
+        """
+
+        error_message = f"Error {message}: couldn't find its first post"
+        print(f"  > {error_message}")
+        self._errors.append(error_message)
+
+        return None
@@ -1,6 +1,8 @@
 #! /bin/bash
 set -exuo pipefail
 
+ORIGINAL_DIR=${PWD}
+
 # Get the right codebase
 # git clone https://github.com/juju/docs ~/git/juju-docs
 cd ~/git/juju-docs/src/en
@@ -11,21 +13,22 @@ git pull
 # Remove files we don't want to include in Discourse
 rm commands.md test.md index.md
 
-# Apply discoursifier conversions
-~/git/discoursifier/convert.py
-
-# Reformat with pandoc to remove newlines
-find . -name '*.md' -exec pandoc --atx-headers -f markdown_mmd+backtick_code_blocks -t markdown_mmd+hard_line_breaks+backtick_code_blocks+shortcut_reference_links {} -o {} \;
-
-# Unescape characters espaced by pandoc
-find . -name '*.md' -exec sed -i -E 's!\\(\[|\*|\^|`|_|[(]|[)]|\$|\]|#|~)!\1!g' {} \;
+# Write the converted files to a separate directory
+OUT_DIR=~/git/juju-docs-discourse
 
-# Fix notification blocks
-find . -name '*.md' -exec sed -i -E 's!(\[note[^]]*\]) !\1\n!g' {} \;
-find . -name '*.md' -exec sed -i -E 's! \[/note\]!\n[/note]!g' {} \;
+# Earlier runs kept their state alongside the source files,
+# so carry it over the first time we convert to a separate directory
+mkdir -p ${OUT_DIR}
+for STATE_FILE in created-topics.json heading-slugs.json; do
+    if [ -f ${STATE_FILE} ] && [ ! -f ${OUT_DIR}/${STATE_FILE} ]; then
+        cp ${STATE_FILE} ${OUT_DIR}/${STATE_FILE}
+    fi
+done
 
-# Add IDs to headings
-~/git/discoursifier/add-header-ids.py
+# Apply discoursifier conversions (including pandoc reformatting and
+# heading IDs)
+~/git/discoursifier/convert.py --out-dir=${OUT_DIR}
+cd ${OUT_DIR}
 
 # Replace "bash" and "no-highlight" code blocks with "text" code blocks
 find . -name '*.md' -exec sed -i -E 's!``` (bash|no-highlight)!``` text!g' {} \;
@@ -44,4 +47,4 @@ if [ "${ready,,}" == "y" ]; then
 fi
 
 # Go back to the original directory
-cd -
+cd ${ORIGINAL_DIR}
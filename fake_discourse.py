@@ -0,0 +1,412 @@
+# Standard library
+import collections
+import datetime
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Discourse's error messages
+not_found = {"errors": ["The requested URL or resource could not be found."]}
+not_permitted = {
+    "errors": ["You are not permitted to view the requested resource."]
+}
+
+
+class FakeDiscourse:
+    """
+    An in-memory stand-in for the parts of the Discourse API
+    that DiscourseAPI uses, for load testing without a real server.
+
+    - latency: Seconds to wait before answering each request
+    - rate_limit: How many requests to allow every "rate_window" seconds,
+      before answering 429 with a "wait N seconds" message, like Discourse
+    - error_rate: The fraction of requests to fail with a 5xx error
+    - page_size: How many topics to list on each page of a category
+    """
+
+    def __init__(
+        self,
+        api_key,
+        category_name="docs",
+        latency=0,
+        rate_limit=None,
+        rate_window=10,
+        error_rate=0,
+        page_size=30,
+        seed=0,
+    ):
+        self.api_key = api_key
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.error_rate = error_rate
+        self.page_size = page_size
+
+        self.requests = collections.Counter()
+
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._request_times = collections.deque()
+        self._next_id = 1
+        self.topics = {}
+        self.posts = {}
+
+        self.category = {
+            "id": 5,
+            "name": category_name,
+            "slug": category_name,
+        }
+
+        # Every category starts with an "About" topic, which can't be deleted
+        about_topic = self._create_topic(
+            f"About the {category_name} category", "About this category."
+        )
+        self.category["topic_url"] = (
+            f"/t/{about_topic['slug']}/{about_topic['id']}"
+        )
+        self._about_topic_id = about_topic["id"]
+
+    def handle(self, method, path, params):
+        """
+        Answer a request, returning the status code and the body,
+        which is HTML if it's a string, or otherwise JSON
+        """
+
+        time.sleep(self.latency)
+
+        with self._lock:
+            status, body = self._handle(method, path, params)
+            endpoint = re.sub(r"/\d+", "/{id}", path)
+            self.requests[f"{method} {endpoint} {status}"] += 1
+
+        return status, body
+
+    def stats(self):
+        """
+        Summarise the requests answered so far
+        """
+
+        with self._lock:
+            total = sum(self.requests.values())
+            statuses = collections.Counter()
+
+            for request, count in self.requests.items():
+                statuses[request.rsplit(" ", 1)[1]] += count
+
+            return {
+                "total_requests": total,
+                "statuses": dict(sorted(statuses.items())),
+                "requests": dict(sorted(self.requests.items())),
+                "topics": len(self.topics),
+            }
+
+    # Private methods
+    # ===
+
+    def _handle(self, method, path, params):
+        if self._is_rate_limited():
+            seconds = max(1, round(self.rate_window / 2))
+
+            return (
+                429,
+                {
+                    "errors": [
+                        "You’ve performed this action too many times. "
+                        f"Please wait {seconds} seconds before trying again."
+                    ],
+                    "error_type": "rate_limit",
+                    "extras": {"wait_seconds": seconds},
+                },
+            )
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            status = self._random.choice([500, 502, 503])
+
+            return status, f"<html>Error {status}</html>"
+
+        category_show = re.fullmatch(r"/c/([^/]+)/show\.json", path)
+        category_page = re.fullmatch(
+            r"/c/(?:[^/]+/)?(\d+)(?:/l/latest)?\.json", path
+        )
+        topic = re.fullmatch(r"/t/(\d+)\.json", path)
+        post = re.fullmatch(r"/posts/(\d+)\.json", path)
+        wiki = re.fullmatch(r"/posts/(\d+)/wiki", path)
+
+        if method == "GET" and category_show:
+            if category_show.group(1) not in (
+                self.category["slug"],
+                str(self.category["id"]),
+            ):
+                return 404, {"errors": ["Category not found"]}
+
+            return 200, {"category": self.category}
+
+        if method == "GET" and category_page:
+            return self._list_topics(int(category_page.group(1)), params)
+
+        if method == "POST" and path == "/posts.json":
+            return self._create_post(params)
+
+        if method == "GET" and topic:
+            return self._get_topic(int(topic.group(1)), params)
+
+        if method == "DELETE" and topic:
+            return self._delete_topic(int(topic.group(1)))
+
+        if method == "PUT" and post:
+            return self._update_post(int(post.group(1)), params)
+
+        if method == "PUT" and wiki:
+            return self._set_wiki(int(wiki.group(1)), params)
+
+        return 404, {"errors": ["Not found"]}
+
+    def _is_rate_limited(self):
+        if not self.rate_limit:
+            return False
+
+        now = time.monotonic()
+
+        while (
+            self._request_times
+            and self._request_times[0] < now - self.rate_window
+        ):
+            self._request_times.popleft()
+
+        if len(self._request_times) >= self.rate_limit:
+            return True
+
+        self._request_times.append(now)
+
+        return False
+
+    def _list_topics(self, category_id, params):
+        if category_id != self.category["id"]:
+            return 404, {"errors": ["Category not found"]}
+
+        page = int(params.get("page", 0))
+        page_size = int(params.get("per_page", self.page_size))
+        topics = sorted(
+            self.topics.values(),
+            key=lambda topic: topic["bumped_at"],
+            reverse=True,
+        )
+        page_topics = topics[page * page_size : (page + 1) * page_size]
+        topic_list = {
+            "per_page": page_size,
+            "topics": [
+                {key: value for key, value in topic.items() if key != "posts"}
+                for topic in page_topics
+            ],
+        }
+
+        if (page + 1) * page_size < len(topics):
+            topic_list["more_topics_url"] = (
+                f"/c/{self.category['slug']}/{self.category['id']}"
+                f"/l/latest?page={page + 1}"
+            )
+
+        return 200, {"topic_list": topic_list}
+
+    def _create_post(self, params):
+        title = params.get("title", "")
+
+        if str(params.get("category")) != str(self.category["id"]):
+            return 422, {"errors": ["Category is invalid"]}
+
+        if not title or not params.get("raw"):
+            return 422, {"errors": ["Title and body can't be empty"]}
+
+        if any(topic["title"] == title for topic in self.topics.values()):
+            return 422, {"errors": ["Title has already been used"]}
+
+        topic = self._create_topic(title, params["raw"])
+        post = self.posts[topic["posts"][0]]
+
+        return (
+            200,
+            dict(post, topic_slug=topic["slug"], topic_id=topic["id"]),
+        )
+
+    def _get_topic(self, topic_id, params):
+        topic = self.topics.get(topic_id)
+
+        if not topic:
+            return 404, not_found
+
+        posts = []
+
+        for post_id in topic["posts"]:
+            post = dict(self.posts[post_id], cooked=self.posts[post_id]["raw"])
+
+            if not params.get("include_raw"):
+                del post["raw"]
+
+            posts.append(post)
+
+        return (
+            200,
+            {
+                "id": topic["id"],
+                "title": topic["title"],
+                "slug": topic["slug"],
+                "post_stream": {"posts": posts},
+            },
+        )
+
+    def _delete_topic(self, topic_id):
+        if topic_id not in self.topics:
+            return 404, not_found
+
+        if topic_id == self._about_topic_id:
+            return 403, not_permitted
+
+        for post_id in self.topics.pop(topic_id)["posts"]:
+            del self.posts[post_id]
+
+        return 200, {}
+
+    def _update_post(self, post_id, params):
+        post = self.posts.get(post_id)
+
+        if not post:
+            return 404, not_found
+
+        post["raw"] = params.get("post[raw]", post["raw"])
+        post["updated_at"] = self._now()
+
+        # Like Discourse, editing a post doesn't bump its topic
+
+        return 200, {"post": post}
+
+    def _set_wiki(self, post_id, params):
+        post = self.posts.get(post_id)
+
+        if not post:
+            return 404, not_found
+
+        post["wiki"] = params.get("wiki", "").lower() == "true"
+
+        return 200, {}
+
+    def _create_topic(self, title, raw):
+        topic_id = self._take_id()
+        post_id = self._take_id()
+        now = self._now()
+
+        self.posts[post_id] = {
+            "id": post_id,
+            "topic_id": topic_id,
+            "post_number": 1,
+            "raw": raw,
+            "wiki": False,
+            "created_at": now,
+            "updated_at": now,
+        }
+        self.topics[topic_id] = {
+            "id": topic_id,
+            "title": title,
+            "slug": re.sub(r"[^a-z0-9]+", "-", title.lower()).strip("-"),
+            "category_id": self.category["id"],
+            "posts_count": 1,
+            "created_at": now,
+            "bumped_at": now,
+            "last_posted_at": now,
+            "posts": [post_id],
+        }
+
+        return self.topics[topic_id]
+
+    def _take_id(self):
+        new_id = self._next_id
+        self._next_id += 1
+
+        return new_id
+
+    def _now(self):
+        # Microseconds, so every change moves the timestamp on
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        return now.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class FakeDiscourseHandler(BaseHTTPRequestHandler):
+    """
+    Pass HTTP requests to the server's FakeDiscourse
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._respond("GET")
+
+    def do_POST(self):
+        self._respond("POST")
+
+    def do_PUT(self):
+        self._respond("PUT")
+
+    def do_DELETE(self):
+        self._respond("DELETE")
+
+    def log_message(self, format, *args):
+        # The load test reports its own summary
+        pass
+
+    # Private methods
+    # ===
+
+    def _respond(self, method):
+        discourse = self.server.discourse
+        url = urlsplit(self.path)
+        params = {
+            key: values[-1] for key, values in parse_qs(url.query).items()
+        }
+        length = int(self.headers.get("Content-Length") or 0)
+
+        if length:
+            body = self.rfile.read(length).decode("utf-8")
+            params.update(
+                {key: values[-1] for key, values in parse_qs(body).items()}
+            )
+
+        if self.headers.get("Api-Key") != discourse.api_key:
+            status, body = 403, not_permitted
+        else:
+            status, body = discourse.handle(method, url.path, params)
+
+        if isinstance(body, str):
+            content_type = "text/html"
+        else:
+            content_type = "application/json"
+            body = json.dumps(body)
+
+        content = body.encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def start_server(discourse, host="127.0.0.1", port=0):
+    """
+    Serve a FakeDiscourse in a background thread,
+    returning the server, whose URL is in "server.url"
+    """
+
+    server = ThreadingHTTPServer((host, port), FakeDiscourseHandler)
+    server.daemon_threads = True
+    server.discourse = discourse
+    server.url = f"http://{host}:{server.server_address[1]}"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
@@ -1,68 +1,397 @@
 # Standard library
+import hashlib
 import json
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from glob import glob
 
 
-def get_created_topics():
+def get_created_topics(path="created-topics.json"):
     """
-    Retrieve a dictionary from the created-topics.json file
+    Retrieve a dictionary from the created-topics.json file,
+    along with any changes since it was saved from its change log
     """
 
     created_topics = {}
 
-    if os.path.isfile("created-topics.json"):
-        with open("created-topics.json") as created_posts_file:
+    if os.path.isfile(path):
+        with open(path) as created_posts_file:
             created_topics = json.load(created_posts_file)
 
+    log_path = _get_change_log_path(path)
+
+    if os.path.isfile(log_path):
+        with open(log_path) as log_file:
+            for line in log_file:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash was never acknowledged
+                    continue
+
+                if change.get("remove"):
+                    created_topics.pop(change["path"], None)
+                else:
+                    created_topics.setdefault(change["path"], {}).update(
+                        change["update"]
+                    )
+
     return created_topics
 
 
-def save_created_topics(created_topics):
+def save_created_topics(created_topics, path="created-topics.json"):
     """
     Update created-topics.json with a new dictionary
+    (which includes any changes in its change log)
+    """
+
+    write_file_atomically(
+        path, json.dumps(created_topics, indent=4, sort_keys=True)
+    )
+
+    log_path = _get_change_log_path(path)
+
+    if os.path.isfile(log_path):
+        os.remove(log_path)
+
+    print(f"  > Saved to {path}")
+
+
+class CreatedTopicsStore:
+    """
+    The dictionary of created topics from created-topics.json,
+    saving changes in batches.
+
+    Each change is appended to a change log as soon as it's made,
+    so none are lost in a crash. The whole file is only rewritten
+    every "flush_count" changes or "flush_interval" seconds,
+    and on "flush()".
+    """
+
+    def __init__(
+        self, path="created-topics.json", flush_count=20, flush_interval=10
+    ):
+        self.path = path
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self.topics = get_created_topics(path)
+
+        # Save what we replayed from a previous run's change log, so we
+        # never append to a line it left unfinished
+        if os.path.isfile(_get_change_log_path(path)):
+            save_created_topics(self.topics, path)
+
+        self._lock = threading.Lock()
+        self._log_file = None
+        self._unsaved_count = 0
+        self._saved_at = time.monotonic()
+
+    def update(self, file_path, **topic_info):
+        """
+        Record new information about a created topic
+        """
+
+        with self._lock:
+            self.topics.setdefault(file_path, {}).update(topic_info)
+            self._log_change({"path": file_path, "update": topic_info})
+
+    def remove(self, file_path):
+        """
+        Forget a created topic
+        """
+
+        with self._lock:
+            self.topics.pop(file_path, None)
+            self._log_change({"path": file_path, "remove": True})
+
+    def flush(self):
+        """
+        Save all changes to created-topics.json
+        """
+
+        with self._lock:
+            self._save()
+
+    # Private methods
+    # ===
+
+    def _log_change(self, change):
+        if not self._log_file:
+            self._log_file = open(_get_change_log_path(self.path), "a")
+
+        self._log_file.write(json.dumps(change) + "\n")
+        self._log_file.flush()
+        os.fsync(self._log_file.fileno())
+        self._unsaved_count += 1
+
+        if (
+            self._unsaved_count >= self.flush_count
+            or time.monotonic() - self._saved_at >= self.flush_interval
+        ):
+            self._save()
+
+    def _save(self):
+        if not self._unsaved_count:
+            return
+
+        if self._log_file:
+            self._log_file.close()
+            self._log_file = None
+
+        save_created_topics(self.topics, self.path)
+        self._unsaved_count = 0
+        self._saved_at = time.monotonic()
+
+
+def reconcile_created_topics(created_topics_store, remote_topics, titles):
+    """
+    Check created topics against a listing of the topics
+    actually in the category, so it costs one request per page
+    of the listing, rather than one per topic:
+
+    - Entries for topics which have gone are pointed at an untracked
+      topic with the same title, if there is one, or otherwise forgotten,
+      so their topics will be created again
+    - Entries for topics whose slug has changed are updated
+    - Untracked topics with the title of a file with no entry are adopted,
+      rather than creating another topic with the same title
+    - Topics which share a title are reported as duplicates
+
+    "titles" maps each file path to the title of its topic.
+
+    Returns a description of each changed entry by path,
+    and the IDs of duplicate topics by title
+    """
+
+    created_topics = created_topics_store.topics
+    remote_by_id = {topic["id"]: topic for topic in remote_topics}
+    remote_by_title = defaultdict(list)
+
+    # Oldest first, so we adopt the original of any duplicates
+    for topic in sorted(remote_topics, key=lambda topic: topic["id"]):
+        remote_by_title[topic["title"]].append(topic)
+
+    tracked_ids = {topic_info["id"] for topic_info in created_topics.values()}
+
+    # We can't tell which topic belongs to which file if files share a title
+    title_counts = Counter(titles.values())
+    changes = {}
+
+    for path in sorted(set(titles) | set(created_topics)):
+        topic_info = created_topics.get(path)
+        remote_topic = topic_info and remote_by_id.get(topic_info["id"])
+
+        if remote_topic:
+            if remote_topic["slug"] != topic_info["slug"]:
+                created_topics_store.update(path, slug=remote_topic["slug"])
+                changes[path] = f"new slug {remote_topic['slug']}"
+
+            continue
+
+        title = titles.get(path)
+        untracked_topics = [
+            topic
+            for topic in remote_by_title.get(title, [])
+            if topic["id"] not in tracked_ids
+        ]
+
+        if untracked_topics and title_counts[title] == 1:
+            topic = untracked_topics[0]
+            created_topics_store.remove(path)
+            created_topics_store.update(
+                path,
+                slug=topic["slug"],
+                id=topic["id"],
+                wiki=False,
+                links_updated=False,
+            )
+            tracked_ids.add(topic["id"])
+            changes[path] = f"adopted topic {topic['id']}"
+        elif topic_info:
+            created_topics_store.remove(path)
+            changes[path] = f"forgot topic {topic_info['id']}, which is gone"
+
+    duplicates = {
+        title: [topic["id"] for topic in topics]
+        for title, topics in remote_by_title.items()
+        if len(topics) > 1
+    }
+
+    for path, change in changes.items():
+        print(f"  > {path}: {change}")
+
+    for title, topic_ids in duplicates.items():
+        print(
+            f"  > Duplicate topics titled '{title}': "
+            f"{', '.join(str(topic_id) for topic_id in topic_ids)}"
+        )
+
+    return changes, duplicates
+
+
+def find_markdown_files(out_dir="."):
+    """
+    Find every markdown file below the current directory, sorted,
+    so the files are always processed in the same order.
+
+    When writing to a separate "out_dir" inside the current directory,
+    skip any files already in it
+    """
+
+    out_dir = os.path.abspath(out_dir)
+    paths = sorted(glob("**/*.md", recursive=True))
+
+    if out_dir == os.path.abspath("."):
+        return paths
+
+    return [
+        path
+        for path in paths
+        if os.path.commonpath([out_dir, os.path.abspath(path)]) != out_dir
+    ]
+
+
+def write_file_atomically(path, content):
+    """
+    Write a file by writing a temporary file next to it and renaming it,
+    so the file is never left half-written
+    """
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=directory, prefix=".", suffix=".tmp"
+    )
+
+    try:
+        with os.fdopen(file_descriptor, "w") as temporary_file:
+            temporary_file.write(content)
+
+        if os.path.exists(path):
+            shutil.copymode(path, temporary_path)
+        else:
+            os.chmod(temporary_path, 0o644)
+
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def save_metrics(metrics, path):
+    """
+    Save API metrics to a file, in Prometheus textfile format
+    if the path ends in ".prom", or as JSON otherwise
+    """
+
+    if path.endswith(".prom"):
+        write_file_atomically(path, metrics.to_prometheus())
+    else:
+        write_file_atomically(path, metrics.to_json())
+
+    print(f"- Saved metrics to {path}")
+
+
+def content_hash(markdown):
     """
+    Get a hash of some markdown, to tell if it has changed
+    since we last sent it to the API
+    """
+
+    return hashlib.sha256(markdown.encode("utf-8")).hexdigest()
 
-    with open("created-topics.json", "w") as created_topics_file:
-        json.dump(
-            created_topics, created_topics_file, indent=4, sort_keys=True
+
+def topic_url(topic):
+    """
+    Get the relative Discourse URL for a created topic
+    """
+
+    return f"/t/{topic['slug']}/{topic['id']}"
+
+
+def build_link_replacer(topics):
+    """
+    Given a dictionary of created Discourse topics,
+    build a function that rewrites links to any of their files
+    (e.g. "(../some-page.md" or 'href="some-page.html')
+    into links to the topics, in a single pass over the markdown.
+
+    The function returns the new markdown and the number of links rewritten.
+    """
+
+    topic_urls = {
+        path[:-3]: topic_url(topic)
+        for path, topic in topics.items()
+        if path.endswith(".md")
+    }
+
+    if not topic_urls:
+        return lambda markdown: (markdown, 0)
+
+    # Longest names first, so a name never shadows a longer one it prefixes
+    file_names = sorted(topic_urls, key=len, reverse=True)
+    link_pattern = re.compile(
+        r'([ (]|href=")[\./]*('
+        + "|".join(re.escape(file_name) for file_name in file_names)
+        + r")[.](?:md|html)"
+    )
+
+    def replace_links(markdown):
+        return link_pattern.subn(
+            lambda match: match.group(1) + topic_urls[match.group(2)],
+            markdown,
         )
-        print("  > Saved to created-topics.json")
+
+    return replace_links
 
 
 def generate_nav_markdown(sections, topics):
     """
     Given a tree of navigation sections and
     a dictionary of created Discourse topics,
-    generate nav markdown to link to those topics
+    generate nav markdown to link to those topics.
+
+    Top-level sections become headings, and everything below them
+    becomes nested lists, however deep the tree goes
     """
 
-    nav_markdown = ""
+    topic_urls = {path: topic_url(topic) for path, topic in topics.items()}
+    lines = []
 
-    for section in sections:
-        if "location" in section:
-            path = section["location"]
+    def add_items(items, depth):
+        for item in items:
+            title = item["title"]
 
-            if path in topics:
-                topic = topics[path]
-                path = f"/t/{topic['slug']}/{topic['id']}"
+            if "location" in item:
+                path = item["location"]
+                title = f"[{title}]({topic_urls.get(path, path)})"
 
-            nav_markdown += f"## [{section['title']}]({path})\n\n"
-        else:
-            nav_markdown += f"## {section['title']}\n\n"
+            if depth == 0:
+                lines.append(f"## {title}\n\n")
+            else:
+                lines.append(f"{'  ' * (depth - 1)}- {title}\n")
 
-        if "children" in section:
-            for item in section["children"]:
-                if 'location' in item:
-                    path = item["location"]
+            if "children" in item:
+                add_items(item["children"], depth + 1)
 
-                    if path in topics:
-                        topic = topics[path]
-                        path = f"/t/{topic['slug']}/{topic['id']}"
+                # A blank line after each section's list
+                if depth == 0:
+                    lines.append("\n")
 
-                    nav_markdown += f"- [{item['title']}]({path})\n"
-                else:
-                    nav_markdown += f"- {item['title']}"
+    add_items(sections, depth=0)
+
+    return "".join(lines)
 
-            nav_markdown += "\n"
 
-    return nav_markdown
+def _get_change_log_path(path):
+    """
+    Get the path to the change log for a created topics file
+    """
+
+    return os.path.splitext(path)[0] + ".log"
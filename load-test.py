@@ -0,0 +1,249 @@
+#! /usr/bin/env python3
+
+# Standard library
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+# Local imports
+from fake_discourse import FakeDiscourse, start_server
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description=(
+        "Run upload.py and delete.py against a local fake Discourse, "
+        "and report how many requests they made, and how fast"
+    )
+)
+
+parser.add_argument(
+    "--files", type=int, default=100, help=("Number of files to upload")
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=4,
+    help=("Number of workers for upload.py and delete.py"),
+)
+parser.add_argument(
+    "--max-rate",
+    type=float,
+    help=("Most API requests per second for upload.py and delete.py to send"),
+)
+parser.add_argument(
+    "--latency",
+    type=float,
+    default=0.05,
+    help=("Seconds the server takes to answer each request"),
+)
+parser.add_argument(
+    "--rate-limit",
+    type=int,
+    help=("Requests the server allows every --rate-window seconds, if any"),
+)
+parser.add_argument(
+    "--rate-window",
+    type=int,
+    default=10,
+    help=("Seconds over which the server's rate limit is counted"),
+)
+parser.add_argument(
+    "--error-rate",
+    type=float,
+    default=0,
+    help=("Fraction of requests the server fails with a 5xx error"),
+)
+parser.add_argument(
+    "--page-size",
+    type=int,
+    default=30,
+    help=("Topics on each page of the category listing"),
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=0,
+    help=("Seed for the server's injected errors"),
+)
+parser.add_argument(
+    "--output", help=("Save the results to this file, as JSON")
+)
+parser.add_argument(
+    "--keep-dir",
+    action="store_true",
+    help=("Keep the working directory, with each script's output"),
+)
+
+args = parser.parse_args()
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+api_key = "load-test-key"
+
+
+def write_corpus(directory, file_count):
+    """
+    Write converted files that link to each other, with the
+    title-map.json and metadata.yaml that upload.py reads
+    """
+
+    names = [f"page-{index:05}" for index in range(file_count)]
+    title_map = {}
+
+    for index, name in enumerate(names):
+        next_name = names[(index + 1) % file_count]
+        title_map[f"{name}.md"] = f"Page {index}"
+
+        with open(os.path.join(directory, f"{name}.md"), "w") as page_file:
+            page_file.write(
+                f"Some content for page {index}.\n\n"
+                f"See [the next page]({next_name}.md), "
+                f'or <a href="../{next_name}.html">the same page</a>.\n'
+            )
+
+    with open(os.path.join(directory, "title-map.json"), "w") as map_file:
+        json.dump(title_map, map_file, indent=4)
+
+    # Ten pages to a section
+    with open(os.path.join(directory, "metadata.yaml"), "w") as nav_file:
+        nav_file.write("navigation:\n")
+
+        for start in range(0, file_count, 10):
+            nav_file.write(f"  - title: Section {start // 10}\n")
+            nav_file.write("    children:\n")
+
+            for name in names[start : start + 10]:
+                nav_file.write(f"      - title: {title_map[name + '.md']}\n")
+                nav_file.write(f"        location: {name}.md\n")
+
+
+def run_script(name, directory, discourse, extra_arguments=[]):
+    """
+    Run one of the scripts against the fake Discourse,
+    and work out how many requests it made, and how fast
+    """
+
+    before = Counter(discourse.stats()["requests"])
+    metrics_path = os.path.join(directory, f"{name}-metrics.json")
+    log_path = os.path.join(directory, f"{name}.log")
+    command = [
+        sys.executable,
+        os.path.join(scripts_dir, name.split("-")[0] + ".py"),
+        "--api-url",
+        server.url,
+        "--api-key",
+        api_key,
+        "--workers",
+        str(args.workers),
+        "--metrics-file",
+        metrics_path,
+    ] + extra_arguments
+
+    if args.max_rate:
+        command += ["--max-rate", str(args.max_rate)]
+
+    print(f"- Running {name} ...")
+    start_time = time.monotonic()
+
+    with open(log_path, "w") as log_file:
+        process = subprocess.run(
+            command, cwd=directory, stdout=log_file, stderr=subprocess.STDOUT
+        )
+
+    wall_time = time.monotonic() - start_time
+    requests = Counter(discourse.stats()["requests"]) - before
+    statuses = Counter()
+
+    for request, count in requests.items():
+        statuses[request.rsplit(" ", 1)[1]] += count
+
+    result = {
+        "exit_code": process.returncode,
+        "wall_seconds": round(wall_time, 3),
+        "requests": sum(requests.values()),
+        "requests_per_second": round(sum(requests.values()) / wall_time, 1),
+        "statuses": dict(sorted(statuses.items())),
+        "endpoints": dict(sorted(requests.items())),
+    }
+
+    if os.path.isfile(metrics_path):
+        with open(metrics_path) as metrics_file:
+            client_metrics = json.load(metrics_file)
+
+        result["client"] = {
+            counter: sum(call[counter] for call in client_metrics)
+            for counter in ["retries", "rate_limited", "wait_seconds"]
+        }
+
+    print(
+        f"  > {result['requests']} requests in {result['wall_seconds']}s "
+        f"({result['requests_per_second']} requests/second), "
+        f"statuses: {result['statuses']}"
+    )
+
+    if "client" in result:
+        print(
+            f"  > {result['client']['retries']} retries, "
+            f"{result['client']['rate_limited']} rate limited, "
+            f"{result['client']['wait_seconds']:.1f}s waiting"
+        )
+
+    if process.returncode:
+        print(f"  > Exited with {process.returncode}, see {log_path}")
+
+    return result
+
+
+directory = tempfile.mkdtemp(prefix="discoursifier-load-test-")
+
+discourse = FakeDiscourse(
+    api_key=api_key,
+    latency=args.latency,
+    rate_limit=args.rate_limit,
+    rate_window=args.rate_window,
+    error_rate=args.error_rate,
+    page_size=args.page_size,
+    seed=args.seed,
+)
+server = start_server(discourse)
+
+print(f"- Fake Discourse at {server.url}, working in {directory}")
+
+write_corpus(directory, args.files)
+
+results = {
+    "settings": vars(args),
+    "runs": {
+        # The first upload creates every topic, the second has nothing to do
+        "upload": run_script("upload", directory, discourse),
+        "upload-again": run_script("upload-again", directory, discourse),
+        "delete": run_script(
+            "delete", directory, discourse, ["--prune-created-topics"]
+        ),
+    },
+}
+results["total"] = discourse.stats()
+
+server.shutdown()
+server.server_close()
+
+print(
+    f"\n> {results['total']['total_requests']} requests in total, "
+    f"{results['total']['topics']} topics left"
+)
+
+if args.output:
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=4)
+
+    print(f"> Saved results to {args.output}")
+
+if args.keep_dir:
+    print(f"> Kept {directory}")
+else:
+    shutil.rmtree(directory)
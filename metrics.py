@@ -0,0 +1,229 @@
+# Standard library
+import collections
+import json
+import threading
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+def _percentile(sorted_values, percent):
+    """
+    Get a percentile of a sorted list, by the nearest-rank method
+    """
+
+    if not sorted_values:
+        return 0
+
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+
+    return sorted_values[int(rank) - 1]
+
+
+class Metrics:
+    """
+    Counts, latencies and sizes of API requests,
+    by operation (e.g. "create") and endpoint (e.g. "POST /posts.json").
+    Safe to record from several threads at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = collections.defaultdict(
+            lambda: {
+                "requests": 0,
+                "errors": 0,
+                "rate_limited": 0,
+                "retries": 0,
+                "bytes_sent": 0,
+                "bytes_received": 0,
+                "wait_seconds": 0.0,
+                "latencies": [],
+            }
+        )
+
+    def record_request(
+        self, operation, endpoint, latency, ok, bytes_sent, bytes_received
+    ):
+        """
+        Record one request sent to the API, and its response
+        - ok: False if the request failed, other than with a 429
+        """
+
+        with self._lock:
+            call = self._calls[(operation, endpoint)]
+            call["requests"] += 1
+            call["errors"] += 0 if ok else 1
+            call["bytes_sent"] += bytes_sent
+            call["bytes_received"] += bytes_received
+            call["latencies"].append(latency)
+
+    def record_rate_limited(self, operation, endpoint):
+        """
+        Record a request that got a 429 response
+        """
+
+        with self._lock:
+            self._calls[(operation, endpoint)]["rate_limited"] += 1
+
+    def record_retry(self, operation, endpoint):
+        """
+        Record a request being retried after an error
+        """
+
+        with self._lock:
+            self._calls[(operation, endpoint)]["retries"] += 1
+
+    def record_wait(self, operation, endpoint, seconds):
+        """
+        Record time spent waiting for a rate limit or retry
+        """
+
+        with self._lock:
+            self._calls[(operation, endpoint)]["wait_seconds"] += seconds
+
+    def summary(self):
+        """
+        Get totals and latency percentiles for each operation and endpoint
+        """
+
+        summary = []
+
+        with self._lock:
+            for (operation, endpoint), call in sorted(self._calls.items()):
+                latencies = sorted(call["latencies"])
+                summary.append(
+                    {
+                        "operation": operation,
+                        "endpoint": endpoint,
+                        "requests": call["requests"],
+                        "errors": call["errors"],
+                        "rate_limited": call["rate_limited"],
+                        "retries": call["retries"],
+                        "bytes_sent": call["bytes_sent"],
+                        "bytes_received": call["bytes_received"],
+                        "wait_seconds": call["wait_seconds"],
+                        "latency_seconds": {
+                            "total": sum(latencies),
+                            "p50": _percentile(latencies, 50),
+                            "p90": _percentile(latencies, 90),
+                            "p99": _percentile(latencies, 99),
+                            "max": latencies[-1] if latencies else 0,
+                        },
+                        "latency_buckets": {
+                            str(bucket): sum(
+                                1 for latency in latencies if latency <= bucket
+                            )
+                            for bucket in latency_buckets
+                        },
+                    }
+                )
+
+        return summary
+
+    def print_summary(self):
+        """
+        Print a line of totals and percentiles for each kind of request
+        """
+
+        summary = self.summary()
+
+        if not summary:
+            return summary
+
+        print("API requests:")
+
+        for call in summary:
+            latency = call["latency_seconds"]
+            print(
+                f"- {call['operation']} {call['endpoint']}: "
+                f"{call['requests']} requests, {call['errors']} errors, "
+                f"{call['rate_limited']} rate limited, "
+                f"{call['retries']} retries; "
+                f"p50 {latency['p50']:.2f}s, p90 {latency['p90']:.2f}s, "
+                f"p99 {latency['p99']:.2f}s, max {latency['max']:.2f}s; "
+                f"{call['bytes_sent'] / 1024:.0f} KiB sent, "
+                f"{call['bytes_received'] / 1024:.0f} KiB received; "
+                f"{call['wait_seconds']:.1f}s waiting"
+            )
+
+        total_requests = sum(call["requests"] for call in summary)
+        total_latency = sum(
+            call["latency_seconds"]["total"] for call in summary
+        )
+        total_wait = sum(call["wait_seconds"] for call in summary)
+        print(
+            f"Total: {total_requests} requests, "
+            f"{total_latency:.1f}s waiting for responses, "
+            f"{total_wait:.1f}s waiting for rate limits and retries"
+        )
+
+        return summary
+
+    def to_json(self):
+        """
+        Format the metrics summary as JSON
+        """
+
+        return json.dumps(self.summary(), indent=4)
+
+    def to_prometheus(self, prefix="discoursifier_api"):
+        """
+        Format the metrics for the Prometheus node exporter's
+        textfile collector
+        """
+
+        summary = self.summary()
+        lines = []
+        counters = [
+            ("requests", "Requests sent"),
+            ("errors", "Requests that failed, other than with a 429"),
+            ("rate_limited", "Requests rate limited with a 429"),
+            ("retries", "Requests retried after an error"),
+            ("bytes_sent", "Bytes of request bodies sent"),
+            ("bytes_received", "Bytes of response bodies received"),
+            ("wait_seconds", "Seconds waiting for rate limits and retries"),
+        ]
+
+        for name, description in counters:
+            lines.append(f"# HELP {prefix}_{name}_total {description}")
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+
+            for call in summary:
+                lines.append(
+                    f"{prefix}_{name}_total{{{self._labels(call)}}} "
+                    f"{call[name]}"
+                )
+
+        histogram = f"{prefix}_request_duration_seconds"
+        lines.append(f"# HELP {histogram} Time to get a response")
+        lines.append(f"# TYPE {histogram} histogram")
+
+        for call in summary:
+            labels = self._labels(call)
+
+            for bucket, count in call["latency_buckets"].items():
+                lines.append(
+                    f'{histogram}_bucket{{{labels},le="{bucket}"}} {count}'
+                )
+
+            lines.append(
+                f'{histogram}_bucket{{{labels},le="+Inf"}} {call["requests"]}'
+            )
+            lines.append(
+                f"{histogram}_sum{{{labels}}} "
+                f"{call['latency_seconds']['total']}"
+            )
+            lines.append(f"{histogram}_count{{{labels}}} {call['requests']}")
+
+        return "\n".join(lines) + "\n"
+
+    # Private methods
+    # ===
+
+    def _labels(self, call):
+        return ",".join(
+            f'{name}="{json.dumps(call[name])[1:-1]}"'
+            for name in ["operation", "endpoint"]
+        )
@@ -0,0 +1,182 @@
+#! /usr/bin/env python3
+
+# Standard packages
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Local imports
+from discourse_api import DiscourseAPI
+from helpers import save_metrics, write_file_atomically
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description=(
+        "Download the markdown of every topic in a Discourse category "
+        "into a local directory, only fetching topics that have changed"
+    )
+)
+
+parser.add_argument("--api-key", required=True)
+parser.add_argument("--api-url", required=True)
+parser.add_argument("--api-username", default="system")
+parser.add_argument(
+    "--category", default="docs", help=("Category to mirror")
+)
+parser.add_argument(
+    "--mirror-dir",
+    default="mirror",
+    help=("Directory to download topics into, along with manifest.json"),
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help=("Number of topics to download concurrently"),
+)
+parser.add_argument(
+    "--full",
+    action="store_true",
+    help=(
+        "Download every topic again, even if it hasn't been bumped "
+        "(Discourse doesn't bump topics for edits to their first post)"
+    ),
+)
+parser.add_argument(
+    "--max-rate",
+    type=float,
+    help=(
+        "Most API requests per second to send "
+        "(the rate is also learned from the API's 429 responses)"
+    ),
+)
+parser.add_argument(
+    "--metrics-file",
+    help=(
+        "Save API request metrics to this file, as JSON, "
+        "or in Prometheus textfile format if it ends in .prom"
+    ),
+)
+
+args = parser.parse_args()
+
+api = DiscourseAPI(
+    url=args.api_url.rstrip("/"),
+    username=args.api_username,
+    key=args.api_key,
+    category_name=args.category,
+    pool_size=args.workers,
+    max_rate=args.max_rate,
+)
+
+# The previous snapshot, by topic ID
+manifest_path = os.path.join(args.mirror_dir, "manifest.json")
+manifest = {}
+
+if os.path.isfile(manifest_path):
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+os.makedirs(args.mirror_dir, exist_ok=True)
+
+print("- Listing all topics in the category")
+topics = {
+    str(topic["id"]): topic
+    for topic in api.iter_category_topics(
+        fields=["id", "title", "slug", "bumped_at", "last_posted_at"]
+    )
+}
+
+
+def needs_download(topic_id, topic):
+    """
+    Whether a topic has changed since the previous snapshot
+    """
+
+    entry = manifest.get(topic_id)
+
+    return (
+        args.full
+        or not entry
+        or entry["bumped_at"] != topic["bumped_at"]
+        or entry["last_posted_at"] != topic["last_posted_at"]
+        or not os.path.isfile(os.path.join(args.mirror_dir, entry["path"]))
+    )
+
+
+changed_ids = [
+    topic_id
+    for topic_id, topic in topics.items()
+    if needs_download(topic_id, topic)
+]
+removed_ids = [topic_id for topic_id in manifest if topic_id not in topics]
+
+print(
+    f"- {len(topics)} topics, {len(changed_ids)} to download, "
+    f"{len(removed_ids)} no longer in the category"
+)
+
+# Workers finish concurrently, so all changes to the manifest
+# happen under this lock
+manifest_lock = threading.Lock()
+
+
+def remove_file(path):
+    """
+    Remove a downloaded topic from the mirror directory
+    """
+
+    full_path = os.path.join(args.mirror_dir, path)
+
+    if os.path.isfile(full_path):
+        os.remove(full_path)
+
+
+def download_topic(topic_id):
+    """
+    Download the markdown of a topic's first post,
+    and record it in the manifest
+    """
+
+    topic = topics[topic_id]
+    markdown = api.get_topic_markdown(int(topic_id))
+
+    if markdown is None:
+        return
+
+    path = f"{topic['slug']}-{topic_id}.md"
+    write_file_atomically(os.path.join(args.mirror_dir, path), markdown)
+
+    with manifest_lock:
+        previous_entry = manifest.get(topic_id)
+
+        # The slug changes with the title
+        if previous_entry and previous_entry["path"] != path:
+            remove_file(previous_entry["path"])
+
+        manifest[topic_id] = dict(
+            topic, path=path, post_id=api.post_ids.get(int(topic_id))
+        )
+
+
+try:
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(download_topic, changed_ids))
+finally:
+    # Keep whatever was downloaded, even if we were interrupted
+    for topic_id in removed_ids:
+        remove_file(manifest.pop(topic_id)["path"])
+
+    write_file_atomically(
+        manifest_path, json.dumps(manifest, indent=4, sort_keys=True)
+    )
+    print(f"- Saved {len(manifest)} topics to {manifest_path}")
+
+api.metrics.print_summary()
+
+if args.metrics_file:
+    save_metrics(api.metrics, args.metrics_file)
+
+api.print_errors()
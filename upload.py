@@ -2,16 +2,23 @@
 
 # Standard packages
 import argparse
+import atexit
 import json
-import re
+import threading
 import yaml
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 # Local imports
 from discourse_api import DiscourseAPI
 from helpers import (
+    build_link_replacer,
+    content_hash,
+    CreatedTopicsStore,
     generate_nav_markdown,
     get_created_topics,
-    save_created_topics,
+    reconcile_created_topics,
+    save_metrics,
 )
 
 # Arguments
@@ -26,111 +33,271 @@ parser.add_argument("--title-map", default="title-map.json")
 parser.add_argument(
     "--category", default="docs", help=("Category for created posts")
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help=("Number of topics to upload to the API concurrently"),
+)
+parser.add_argument(
+    "--timeout",
+    type=int,
+    default=30,
+    help=("Seconds to wait for the API before giving up on a request"),
+)
+parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help=("Summarise what would be sent to the API, without sending it"),
+)
+parser.add_argument(
+    "--no-reconcile",
+    action="store_true",
+    help=(
+        "Trust created-topics.json, "
+        "without checking it against the topics in the category"
+    ),
+)
+parser.add_argument(
+    "--max-rate",
+    type=float,
+    help=(
+        "Most API requests per second to send "
+        "(the rate is also learned from the API's 429 responses)"
+    ),
+)
+parser.add_argument(
+    "--metrics-file",
+    help=(
+        "Save API request metrics to this file, as JSON, "
+        "or in Prometheus textfile format if it ends in .prom"
+    ),
+)
 
 args = parser.parse_args()
 
-api = DiscourseAPI(
-    url=args.api_url.rstrip("/"),
-    username=args.api_username,
-    key=args.api_key,
-    category_name=args.category,
-)
+api = None
+
+if not args.dry_run:
+    api = DiscourseAPI(
+        url=args.api_url.rstrip("/"),
+        username=args.api_username,
+        key=args.api_key,
+        category_name=args.category,
+        pool_size=args.workers,
+        timeout=args.timeout,
+        max_rate=args.max_rate,
+    )
 
 
 with open(args.title_map) as title_map_file:
     paths = json.load(title_map_file)
 
-# Get created topics
-created_topics = get_created_topics()
+# Get created topics, and make sure all changes are saved when we exit
+if args.dry_run:
+    # Only read them, as the store saves any leftover change log
+    created_topics_store = None
+    created_topics = get_created_topics()
+else:
+    created_topics_store = CreatedTopicsStore()
+    created_topics = created_topics_store.topics
+    atexit.register(created_topics_store.flush)
 
-# Create / update all topics
-# ===
-for file_path, title in paths.items():
-    # Read file
-    with open(file_path) as post_content_file:
-        post_content = post_content_file.read()
+# The documentation index is uploaded like any other file
+metadata_filepath = "metadata.yaml"
+index_title = "Documentation index"
 
-    # Create or update topic
-    if file_path in created_topics:
-        topic_id = created_topics[file_path]["id"]
-        print(f"- Updating topic {topic_id} with {file_path} ...")
-        api.update_topic_content(topic_id, post_content)
+# Repair created topics from the category listing, so we don't update
+# topics that were deleted, or create topics that already exist
+if api and not args.no_reconcile:
+    print("- Checking created topics against the category")
+    reconcile_created_topics(
+        created_topics_store,
+        remote_topics=list(
+            api.iter_category_topics(fields=["id", "title", "slug"])
+        ),
+        titles=dict(paths, **{metadata_filepath: index_title}),
+    )
+
+# We already know the first post of any topic we've created
+if api:
+    api.post_ids.update(
+        {
+            topic_info["id"]: topic_info["post_id"]
+            for topic_info in created_topics.values()
+            if "post_id" in topic_info
+        }
+    )
+
+# What a dry run would have done
+dry_run_counts = Counter()
+dry_run_counts_lock = threading.Lock()
+
+
+def skip_for_dry_run(file_path, steps):
+    """
+    In a dry run, report the API calls we would have made, and return True
+    """
+
+    if not args.dry_run:
+        return False
+
+    print(f"- Would {', '.join(steps)} {file_path}")
+
+    with dry_run_counts_lock:
+        dry_run_counts.update(steps)
+
+    return True
+
+
+def reserve_topic(file_path, title):
+    """
+    Make sure a file has a wiki topic to upload into,
+    creating it with placeholder content if needed,
+    so we know its URL before writing links to it
+    """
+
+    topic_info = created_topics.get(file_path)
+
+    if not topic_info:
+        steps = ["create", "wiki"]
+    elif not topic_info["wiki"]:
+        steps = ["wiki"]
     else:
-        print(f"- Creating topic from {file_path} ...")
-        response = api.create_topic(title, post_content)
+        return
+
+    if skip_for_dry_run(file_path, steps):
+        return
+
+    if "create" in steps:
+        print(f"- Creating topic for {file_path} ...")
+        response = api.create_topic(
+            title, f"This topic will contain the content of `{file_path}`."
+        )
 
         if response.ok:
-            created_topics[file_path] = {
-                "slug": response.json()["topic_slug"],
-                "id": response.json()["topic_id"],
-                "wiki": False,
-                "links_updated": False,
-            }
-            save_created_topics(created_topics)
+            created_topics_store.update(
+                file_path,
+                slug=response.json()["topic_slug"],
+                id=response.json()["topic_id"],
+                post_id=response.json()["id"],
+                wiki=False,
+                links_updated=False,
+            )
 
     # If success, convert to wiki
     if file_path in created_topics:
         topic_id = created_topics[file_path]["id"]
 
-        if created_topics[file_path]["wiki"]:
-            print(f"  > Topic {topic_id} already converted to wiki")
-        else:
-            if api.convert_topic_to_wiki(topic_id):
-                created_topics[file_path]["wiki"] = True
-                save_created_topics(created_topics)
+        if api.convert_topic_to_wiki(topic_id):
+            created_topics_store.update(file_path, wiki=True)
 
-# Update links in topics
-# ===
-for file_path, topic_info in created_topics.items():
-    print(f"- Updating links in topic {topic_info['id']}")
-    markdown = api.get_topic_markdown(topic_info["id"])
 
-    # Iterate through all created posts again, to replace links for each
-    for nested_file_path, nested_topic_info in created_topics.items():
-        file_name = nested_file_path[:-3]
+def upload_topic(file_path):
+    """
+    Upload the content of a file into its topic, with links to other
+    files rewritten to their topics, unless it's what we last pushed
+    """
 
-        nested_topic_url = (
-            f"/t/{nested_topic_info['slug']}/{nested_topic_info['id']}"
-        )
-        markdown = re.sub(
-            f'([ (]|href=")[\./]*{file_name}[.](md|html)',
-            f"\\1{nested_topic_url}",
-            markdown,
+    topic_info = created_topics.get(file_path)
+
+    if not topic_info:
+        # Only possible in a dry run, or if creating the topic failed
+        skip_for_dry_run(file_path, ["update"])
+        return
+
+    # Read file
+    with open(file_path) as post_content_file:
+        post_content = post_content_file.read()
+
+    markdown, links_count = replace_links(post_content)
+    final_hash = content_hash(markdown)
+
+    if topic_info.get("final_hash") == final_hash:
+        print(f"- {file_path} unchanged in topic {topic_info['id']}")
+        return
+
+    if skip_for_dry_run(file_path, ["update"]):
+        return
+
+    topic_id = topic_info["id"]
+    print(
+        f"- Updating topic {topic_id} with {file_path} "
+        f"({links_count} links rewritten) ..."
+    )
+
+    if api.update_topic_content(topic_id, markdown):
+        created_topics_store.update(
+            file_path,
+            final_hash=final_hash,
+            links_updated=True,
         )
 
-    if api.update_topic_content(topic_info["id"], markdown):
-        created_topics[file_path]["links_updated"] = True
-        save_created_topics(created_topics)
+    if "post_id" not in topic_info and topic_id in api.post_ids:
+        created_topics_store.update(file_path, post_id=api.post_ids[topic_id])
+
+
+with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    # Make sure every file has a topic
+    # ===
+    list(executor.map(reserve_topic, paths.keys(), paths.values()))
+
+    # Upload the content of every file, with links to other topics
+    # ===
+    replace_links = build_link_replacer(created_topics)
+
+    list(executor.map(upload_topic, paths.keys()))
 
 
 # Create / update documentation index
 # ===
-metadata_filepath = "metadata.yaml"
 
 with open(metadata_filepath) as data_file:
-    metadata = yaml.load(data_file)
+    metadata = yaml.safe_load(data_file)
 
 nav_markdown = generate_nav_markdown(
     sections=metadata["navigation"], topics=created_topics
 )
 
-if metadata_filepath in created_topics:
-    topic_id = created_topics[metadata_filepath]["id"]
+nav_hash = content_hash(nav_markdown)
+index_info = created_topics.get(metadata_filepath)
+
+if index_info and index_info.get("final_hash") == nav_hash:
+    print(f"- Documentation index unchanged in topic {index_info['id']}")
+elif args.dry_run:
+    index_step = "update" if index_info else "create"
+    skip_for_dry_run("documentation index", [index_step])
+elif index_info:
+    topic_id = index_info["id"]
 
-    api.update_topic_content(topic_id, nav_markdown)
-    print(f"- Updated documentation index in {topic_id}")
+    if api.update_topic_content(topic_id, nav_markdown):
+        created_topics_store.update(metadata_filepath, final_hash=nav_hash)
+        print(f"- Updated documentation index in {topic_id}")
 else:
     print(f"- Creating documentation index from {metadata_filepath} ...")
-    response = api.create_topic("Documentation index", nav_markdown)
+    response = api.create_topic(index_title, nav_markdown)
 
     if response.ok:
-        created_topics[metadata_filepath] = {
-            "slug": response.json()["topic_slug"],
-            "id": response.json()["topic_id"],
-            "wiki": False,
-            "links_updated": True,
-        }
-        save_created_topics(created_topics)
+        created_topics_store.update(
+            metadata_filepath,
+            slug=response.json()["topic_slug"],
+            id=response.json()["topic_id"],
+            post_id=response.json()["id"],
+            wiki=False,
+            links_updated=True,
+            final_hash=nav_hash,
+        )
+
+if args.dry_run:
+    print("\nDry run summary:")
+    for step, count in sorted(dry_run_counts.items()):
+        print(f"- {step}: {count}")
+
+# Print out metrics and any errors
+if api:
+    api.metrics.print_summary()
+
+    if args.metrics_file:
+        save_metrics(api.metrics, args.metrics_file)
 
-# Print out any errors
-api.print_errors()
+    api.print_errors()